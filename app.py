@@ -1,31 +1,228 @@
 import os
-import cv2
-import numpy as np
-from flask import Flask, request, send_from_directory, render_template_string, url_for, redirect, jsonify
-from werkzeug.utils import secure_filename
+import io
+import json
+import math
+import uuid
+import zipfile
+import mimetypes
+from flask import Flask, Request, Response, current_app, request, send_file, send_from_directory, render_template_string, url_for, redirect, jsonify, stream_with_context
+from werkzeug.utils import secure_filename, send_file as werkzeug_send_file
+from werkzeug.middleware.proxy_fix import ProxyFix
 import time
-from threading import Thread
-from queue import Queue
+import atexit
+import socket
+from functools import partial
+from threading import Thread, Event
 import logging
 from datetime import datetime
 
+from image_processing import (MAX_DIMENSION, OUTPUT_FORMATS, METHODS, STAGE_VALUES, decode_image,
+                              decode_scale, encode_image, build_pipeline, parse_pipeline, decode_options,
+                              run_pipeline, estimate_pipeline_cost, estimate_pipeline_memory,
+                              read_image_size, sniff_format, is_animated_gif, timed)
+from video_processing import (is_video, video_output_ext, read_video_info_bytes, estimate_video_cost,
+                              estimate_video_memory, sniff_video_format)
+from worker_pool import WorkerPool, run_denoise_job, run_video_job, default_pool_size, \
+    default_tile_workers, default_memory_budget
+from job_store import create_job_store
+from result_cache import ResultCache, content_digest
+from upload_stream import UploadStream, UploadRejected
+from retention import RetentionManager
+from metrics import Registry, CONTENT_TYPE
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+class DenoiserRequest(Request):
+    """
+    Request class that allows bigger bodies for batch uploads and checks
+    single uploads while they stream in
+    """
+    
+    @property
+    def max_content_length(self):
+        if self.endpoint in ('batch_upload', 'api_batch'):
+            return current_app.config['BATCH_MAX_CONTENT_LENGTH']
+        return current_app.config['MAX_CONTENT_LENGTH']
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Batches can be far bigger than memory should hold, so their files
+        # are spooled as usual and checked once read
+        if self.endpoint not in ('index', 'api_denoise'):
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        # Browsers send an empty part when no file was picked; the view reports that
+        if not filename:
+            return UploadStream()
+        # Raised here, the parser stops before reading the file's bytes
+        if not filename.lower().endswith(ALLOWED_EXTENSIONS):
+            raise UploadRejected(UNSUPPORTED_FORMAT_MESSAGE)
+        return UploadStream(partial(check_upload_header, filename), current_app.config['UPLOAD_SNIFF_BYTES'])
+
 app = Flask(__name__)
+app.request_class = DenoiserRequest
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['PROCESSED_FOLDER'] = 'processed'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Limit uploads to 16MB
-app.config['PROCESSING_QUEUE'] = Queue()
+# Batch uploads may be bigger in total, but each image is still limited to 16MB
+app.config['BATCH_MAX_CONTENT_LENGTH'] = int(os.environ.get('BATCH_MAX_CONTENT_LENGTH', 512 * 1024 * 1024))
+app.config['BATCH_MAX_FILES'] = int(os.environ.get('BATCH_MAX_FILES', 500))
+# Images whose header says they have more pixels are refused before the rest
+# of the upload is read
+app.config['MAX_IMAGE_PIXELS'] = int(os.environ.get('MAX_IMAGE_PIXELS', 100_000_000))
+# Bytes at the start of an upload searched for its dimensions; JPEGs keep them
+# after the EXIF and colour profile segments
+app.config['UPLOAD_SNIFF_BYTES'] = int(os.environ.get('UPLOAD_SNIFF_BYTES', 256 * 1024))
+# Shared job store and queue, e.g. JOB_STORE_URL=sqlite:////var/lib/denoiser/jobs.db
+app.config['JOB_STORE_URL'] = os.environ.get('JOB_STORE_URL', 'sqlite:///jobs.db')
+# Images larger than this are spilled to the upload/processed folders instead
+# of being kept in the job store
+app.config['BLOB_SPILL_BYTES'] = int(os.environ.get('BLOB_SPILL_BYTES', 8 * 1024 * 1024))
+# /api/denoise runs jobs estimated to take less than this many seconds inline
+app.config['SYNC_COST_THRESHOLD'] = float(os.environ.get('SYNC_COST_THRESHOLD', 0.25))
+# Interactive jobs estimated to take longer than this many seconds publish a
+# quick low resolution preview before the real filter runs
+app.config['PREVIEW_MIN_COST'] = float(os.environ.get('PREVIEW_MIN_COST', 0.5))
+# Seconds of single core processing the auto method may spend on an image
+app.config['AUTO_TIME_BUDGET'] = float(os.environ.get('AUTO_TIME_BUDGET', 2.0))
+# Longest time a status long poll or event stream is held open. Each one ties
+# up a gunicorn thread meanwhile, so --threads (see procfile) caps how many
+# pages can watch jobs at once
+app.config['STATUS_MAX_WAIT'] = float(os.environ.get('STATUS_MAX_WAIT', 30))
+# How often the dispatcher looks for jobs enqueued by other processes
+app.config['JOB_POLL_INTERVAL'] = float(os.environ.get('JOB_POLL_INTERVAL', 0.5))
+# Worker pool settings, e.g. WORKER_POOL_SIZE=4 WORKER_CV_THREADS=2 gunicorn app:app
+# Note that every gunicorn worker gets its own pool
+app.config['WORKER_POOL_SIZE'] = int(os.environ.get('WORKER_POOL_SIZE', default_pool_size()))
+app.config['WORKER_CV_THREADS'] = int(os.environ.get('WORKER_CV_THREADS', 1))
+app.config['WORKER_DRAIN_TIMEOUT'] = float(os.environ.get('WORKER_DRAIN_TIMEOUT', 60))
+# Bytes of memory the jobs of one pool may use at once (default: half the
+# physical memory). Jobs wait until enough of it is free, and uploads that
+# would need more than all of it are refused
+app.config['WORKER_MEMORY_BUDGET'] = int(os.environ['WORKER_MEMORY_BUDGET']) \
+    if os.environ.get('WORKER_MEMORY_BUDGET') else default_memory_budget()
+# Images run inline by /api/denoise are processed in the web process itself,
+# so they must also be small in memory
+app.config['INLINE_MAX_MEMORY'] = int(os.environ.get('INLINE_MAX_MEMORY', 64 * 1024 * 1024))
+# Jobs processed in parallel by all app processes together, used to turn
+# estimated work into wait times (default: this process's pool size)
+app.config['QUEUE_CAPACITY'] = int(os.environ.get('QUEUE_CAPACITY', app.config['WORKER_POOL_SIZE']))
+# Admission control: new jobs are refused with 429 once the queue holds this
+# many jobs or this many seconds of estimated wait, in total or per client
+app.config['QUEUE_MAX_JOBS'] = int(os.environ.get('QUEUE_MAX_JOBS', 1000))
+app.config['QUEUE_MAX_WAIT'] = float(os.environ.get('QUEUE_MAX_WAIT', 600))
+app.config['CLIENT_MAX_JOBS'] = int(os.environ.get('CLIENT_MAX_JOBS', 500))
+app.config['CLIENT_MAX_WAIT'] = float(os.environ.get('CLIENT_MAX_WAIT', 300))
+# Proxies in front of gunicorn that append to X-Forwarded-For. Clients are told
+# apart by the address the outermost of them saw; anything further left in the
+# header was sent by the client and can't be trusted (0 when there's no proxy)
+app.config['TRUSTED_PROXY_HOPS'] = int(os.environ.get('TRUSTED_PROXY_HOPS', 1))
+# Scheduling: the job with the lowest estimated cost runs first. Each priority
+# class adds a head start in seconds that the job's cost is treated as being
+# higher by, and every second a job waits takes SCHEDULER_AGING_RATE seconds
+# off its cost so long jobs still run eventually
+app.config['PRIORITY_CLASSES'] = {
+    'interactive': 0.0,
+    'batch': float(os.environ.get('BATCH_PRIORITY_PENALTY', 60)),
+}
+app.config['SCHEDULER_AGING_RATE'] = float(os.environ.get('SCHEDULER_AGING_RATE', 0.1))
+# Threads used per job for the tiles of full resolution images (default: the
+# CPUs divided between the workers of the pool)
+app.config['TILE_WORKERS'] = int(os.environ['TILE_WORKERS']) if os.environ.get('TILE_WORKERS') \
+    else default_tile_workers(app.config['WORKER_POOL_SIZE'])
+# Retention: jobs and their images are deleted RETENTION_MAX_AGE seconds after
+# they were created, and the least recently viewed images go first once all
+# images together take more than STORAGE_MAX_BYTES (default: no quota). The
+# cleanup runs every RETENTION_INTERVAL seconds, deleting at most
+# RETENTION_BATCH_SIZE of each kind per run
+app.config['RETENTION_MAX_AGE'] = float(os.environ.get('RETENTION_MAX_AGE', 86400))
+app.config['STORAGE_MAX_BYTES'] = int(os.environ['STORAGE_MAX_BYTES']) \
+    if os.environ.get('STORAGE_MAX_BYTES') else None
+app.config['RETENTION_INTERVAL'] = float(os.environ.get('RETENTION_INTERVAL', 60))
+app.config['RETENTION_BATCH_SIZE'] = int(os.environ.get('RETENTION_BATCH_SIZE', 500))
+# Images are served with their SHA-256 as ETag. URLs carrying the digest
+# (?v=, see blob_url()) always return the same bytes and may be cached this long
+app.config['IMMUTABLE_MAX_AGE'] = int(os.environ.get('IMMUTABLE_MAX_AGE', 365 * 24 * 3600))
+# Let the front proxy send the images that live on disk: '' (Python sends
+# them), 'x-accel' (nginx X-Accel-Redirect) or 'x-sendfile' (Apache,
+# lighttpd). Images below BLOB_SPILL_BYTES live in the job store and are
+# always sent by Python; BLOB_SPILL_BYTES=0 puts every image on disk
+app.config['SENDFILE_MODE'] = os.environ.get('SENDFILE_MODE', '')
+# Internal nginx location that maps to the app's working directory, e.g.
+#   location /_files/ { internal; alias /srv/denoiser/; }
+app.config['X_ACCEL_PREFIX'] = os.environ.get('X_ACCEL_PREFIX', '/_files/')
+# Cache of processed results keyed by upload hash and parameters (0 disables it)
+app.config['RESULT_CACHE_FOLDER'] = os.environ.get('RESULT_CACHE_FOLDER', 'cache')
+app.config['RESULT_CACHE_MAX_BYTES'] = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 512 * 1024 * 1024))
 
-# Create directories if they don't exist
+if app.config['TRUSTED_PROXY_HOPS']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXY_HOPS'], x_proto=0)
+
+# Create directories if they don't exist (used for images that are spilled to disk)
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['PROCESSED_FOLDER'], exist_ok=True)
 
-# Job status tracking
-processing_jobs = {}
+# Job status tracking, shared by all gunicorn workers
+job_store = create_job_store(app.config['JOB_STORE_URL'], spill_bytes=app.config['BLOB_SPILL_BYTES'],
+                             aging_rate=app.config['SCHEDULER_AGING_RATE'])
+
+# Results of earlier jobs, so repeated requests skip the queue entirely
+result_cache = ResultCache(app.config['RESULT_CACHE_FOLDER'], app.config['RESULT_CACHE_MAX_BYTES'])
+
+# Expires jobs and images and keeps them within the storage quota
+retention = RetentionManager(
+    job_store,
+    [app.config['UPLOAD_FOLDER'], app.config['PROCESSED_FOLDER']],
+    max_age=app.config['RETENTION_MAX_AGE'],
+    max_bytes=app.config['STORAGE_MAX_BYTES'],
+    batch_size=app.config['RETENTION_BATCH_SIZE']
+)
+
+# ========== METRICS ==========
+# Exposed on /metrics; values are per process
+metrics = Registry()
+stage_seconds = metrics.histogram(
+    'denoiser_stage_seconds', 'Time spent in each pipeline stage', ['stage'])
+job_seconds = metrics.histogram(
+    'denoiser_job_seconds', 'Worker processing time of a job', ['method'])
+queue_wait_seconds = metrics.histogram(
+    'denoiser_queue_wait_seconds', 'Time jobs spent in the queue before a worker took them')
+jobs_total = metrics.counter(
+    'denoiser_jobs_total', 'Jobs by how they finished (completed, failed, cached, inline, rejected)',
+    ['method', 'status'])
+metrics.gauge('denoiser_jobs', 'Jobs in the shared job store by status', ['status']).set_function(
+    lambda: {(status,): count for status, count in job_store.count_jobs().items()})
+metrics.gauge('denoiser_oldest_pending_job_seconds', 'Age of the oldest job waiting in the queue').set_function(
+    lambda: job_store.oldest_pending_age())
+metrics.gauge('denoiser_worker_pool_size', 'Worker processes of this app process').set_function(
+    lambda: worker_pool.size)
+metrics.gauge('denoiser_worker_pool_busy', 'Worker processes currently running a job').set_function(
+    lambda: worker_pool.active)
+metrics.gauge('denoiser_worker_memory_bytes', 'Estimated memory used by the running jobs').set_function(
+    lambda: worker_pool.memory_in_use)
+metrics.gauge('denoiser_worker_memory_budget_bytes', 'Memory budget of the worker pool').set_function(
+    lambda: worker_pool.memory_budget or 0)
+metrics.gauge('denoiser_storage_bytes', 'Size of the stored uploads and results').set_function(
+    lambda: job_store.blob_bytes())
+metrics.gauge('denoiser_storage_max_bytes', 'Storage quota for uploads and results (0 for none)').set_function(
+    lambda: retention.max_bytes or 0)
+retention_deleted_total = metrics.counter(
+    'denoiser_retention_deleted_total', 'Jobs, images and stray files deleted by the retention cleanup',
+    ['kind'])
+metrics.counter('denoiser_result_cache_hits_total', 'Result cache hits').set_function(
+    lambda: result_cache.stats()['hits'])
+metrics.counter('denoiser_result_cache_misses_total', 'Result cache misses').set_function(
+    lambda: result_cache.stats()['misses'])
+metrics.gauge('denoiser_result_cache_bytes', 'Size of the result cache').set_function(
+    lambda: result_cache.stats()['bytes'])
+metrics.gauge('denoiser_result_cache_max_bytes', 'Size budget of the result cache').set_function(
+    lambda: result_cache.max_bytes)
+
+def observe_stages(timings):
+    """Record the per-stage timings of a job"""
+    for stage, seconds in timings.items():
+        stage_seconds.observe(seconds, stage=stage)
 
 # CSS and HTML templates remain the same as in your original code
 CSS_STYLE = """
@@ -151,7 +348,7 @@ input[type="file"] {
   margin-bottom: 10px;
   color: #555;
 }
-img {
+img, video {
   max-width: 350px;
   max-height: 350px;
   border-radius: 8px;
@@ -286,6 +483,25 @@ hr {
   0% { transform: rotate(0deg); }
   100% { transform: rotate(360deg); }
 }
+.progress {
+  width: 100%;
+  height: 20px;
+  background: #eee;
+  border-radius: 10px;
+  overflow: hidden;
+  margin: 20px 0;
+}
+.progress-bar {
+  height: 100%;
+  width: 0;
+  background: #4285f4;
+  transition: width 0.3s ease;
+}
+select, input[type="number"] {
+  padding: 8px;
+  border-radius: 5px;
+  border: 1px solid #ccc;
+}
 .error-message {
   color: #D32F2F;
   background-color: #FFEBEE;
@@ -316,9 +532,9 @@ INDEX_HTML = """
     <form id="upload-form" action="/" method="POST" enctype="multipart/form-data">
       <div class="upload-area" id="drop-area" onclick="document.getElementById('file-input').click()">
         <div class="upload-icon">📁</div>
-        <p>Click to select or drag and drop an image (max 16MB)</p>
+        <p>Click to select or drag and drop an image or a short video (max 16MB)</p>
       </div>
-      <input type="file" id="file-input" name="image" accept="image/*" required>
+      <input type="file" id="file-input" name="image" accept="image/*,video/*" required>
       <div class="control-panel">
         <div class="slider-container">
           <label for="strength">Denoising Strength: <span id="strength-value">5</span></label>
@@ -345,6 +561,28 @@ INDEX_HTML = """
             <label for="gaussian">Gaussian Filter</label>
           </div>
           <p class="method-description">Simple smoothing for uniform noise.</p>
+          
+          <div class="radio-option">
+            <input type="radio" id="auto" name="method" value="auto">
+            <label for="auto">Automatic</label>
+          </div>
+          <p class="method-description">Measures the noise and picks the method and strength; clean images are left alone.</p>
+        </div>
+        
+        <div class="radio-container">
+          <h3>Processing Mode:</h3>
+          
+          <div class="radio-option">
+            <input type="radio" id="quality-fast" name="quality" value="fast" checked>
+            <label for="quality-fast">Fast</label>
+          </div>
+          <p class="method-description">Large images are scaled down to 1000px before denoising.</p>
+          
+          <div class="radio-option">
+            <input type="radio" id="quality-full" name="quality" value="full">
+            <label for="quality-full">Full Resolution</label>
+          </div>
+          <p class="method-description">Keeps every pixel; large images are processed in parallel tiles.</p>
         </div>
         
         <div class="checkbox-container">
@@ -352,9 +590,34 @@ INDEX_HTML = """
           <label for="grayscale">Convert to Grayscale</label>
         </div>
         
+        <div class="slider-container">
+          <label for="sharpen">Sharpen After Denoising</label>
+          <select id="sharpen" name="sharpen">
+            <option value="0">Off</option>
+            <option value="1">1 (subtle)</option>
+            <option value="2">2</option>
+            <option value="3">3</option>
+            <option value="4">4</option>
+            <option value="5">5 (strong)</option>
+          </select>
+        </div>
+        
+        <div class="slider-container">
+          <label for="format">Output Format</label>
+          <select id="format" name="format">
+            <option value="">Same as upload</option>
+            <option value="jpg">JPEG</option>
+            <option value="png">PNG</option>
+            <option value="webp">WebP (smallest)</option>
+          </select>
+          <label for="output-quality">Quality (JPEG/WebP, 1-100)</label>
+          <input type="number" id="output-quality" name="output_quality" min="1" max="100" placeholder="Default">
+        </div>
+        
         <button type="submit" class="button">Upload & Denoise</button>
       </div>
     </form>
+    <a href="{{ url_for('batch_upload') }}" class="back-link">Processing a whole photo shoot? Use batch upload</a>
   </div>
   <script>
     const strengthSlider = document.getElementById('strength');
@@ -416,41 +679,77 @@ PROCESSING_HTML = """
         </div>
         
         <p>Your image is being processed. Please wait a moment.</p>
+        <p id="estimated-wait"></p>
         <p>Job ID: {{ job_id }}</p>
         
+        <div class="image-box" id="preview-box" {% if not preview_url %}style="display: none;"{% endif %}>
+            <h3>Preview</h3>
+            <img id="preview-image" src="{{ preview_url or '' }}" alt="Preview">
+            <p>This is a quick preview. The full quality result is on its way.</p>
+        </div>
+        
         <a href="#" id="check-status-btn" class="button">Check Status Manually</a>
     </div>
     
     <script>
-        // Polling for status instead of page refresh
+        // Status updates are pushed by the server instead of polled
         const jobId = "{{ job_id }}";
         const statusBtn = document.getElementById('check-status-btn');
         
-        // Set up polling interval (check every 2 seconds)
-        const statusInterval = setInterval(checkJobStatus, 2000);
-        
         // Manual status check
         statusBtn.addEventListener('click', function(e) {
             e.preventDefault();
-            checkJobStatus();
-        });
-        
-        function checkJobStatus() {
             fetch('/api/status/' + jobId)
                 .then(response => response.json())
-                .then(data => {
-                    if (data.status === 'completed') {
-                        clearInterval(statusInterval);
-                        window.location.href = "/status/" + jobId;
-                    } else if (data.status === 'failed') {
-                        clearInterval(statusInterval);
-                        window.location.href = "/status/" + jobId;
-                    }
-                    // For pending or processing, just keep polling
-                })
+                .then(handleStatus)
                 .catch(error => {
                     console.error('Error checking status:', error);
                 });
+        });
+        
+        function handleStatus(data) {
+            if (data.status === 'completed' || data.status === 'failed') {
+                window.location.href = "/status/" + jobId;
+                return true;
+            }
+            if (data.preview_url) {
+                const previewImage = document.getElementById('preview-image');
+                if (previewImage.getAttribute('src') !== data.preview_url) {
+                    previewImage.src = data.preview_url;
+                }
+                document.getElementById('preview-box').style.display = '';
+            }
+            if (data.estimated_wait !== undefined) {
+                document.getElementById('estimated-wait').textContent =
+                    'Estimated time remaining: about ' + Math.max(1, Math.round(data.estimated_wait)) + ' seconds';
+            }
+            // For pending or processing, keep waiting
+            return false;
+        }
+        
+        if (window.EventSource) {
+            // The stream reconnects by itself if the server closes it
+            const events = new EventSource('/api/events/' + jobId);
+            events.addEventListener('status', function(e) {
+                if (handleStatus(JSON.parse(e.data))) {
+                    events.close();
+                }
+            });
+        } else {
+            // Long poll: the server answers as soon as the status changes
+            (function waitForStatus(status) {
+                fetch('/api/status/' + jobId + '?wait=25&status=' + status)
+                    .then(response => response.json())
+                    .then(data => {
+                        if (!handleStatus(data)) {
+                            waitForStatus(data.status);
+                        }
+                    })
+                    .catch(error => {
+                        console.error('Error checking status:', error);
+                        setTimeout(function() { waitForStatus(status); }, 2000);
+                    });
+            })('pending');
         }
     </script>
 </body>
@@ -483,16 +782,33 @@ RESULT_HTML = """
             <div class="image-wrapper">
                 <div class="image-box">
                     <h3>Original</h3>
-                    <img src="{{ url_for('uploaded_file', filename=filename) }}" alt="Original Image">
+                    {% if video and not filename.lower().endswith('.gif') %}
+                    <video src="{{ input_url }}" controls muted loop></video>
+                    {% else %}
+                    <a href="{{ input_url }}" target="_blank">
+                        <img src="{{ input_thumbnail_url or input_url }}" alt="Original Image">
+                    </a>
+                    {% endif %}
                 </div>
                 <div class="image-box">
                     <h3>Denoised</h3>
-                    <img src="{{ url_for('processed_file', filename=filename) }}" alt="Denoised Image">
+                    {% if video %}
+                    <video src="{{ result_url }}" controls muted loop></video>
+                    {% else %}
+                    <a href="{{ result_url }}" target="_blank">
+                        <img src="{{ output_thumbnail_url or result_url }}" alt="Denoised Image">
+                    </a>
+                    {% endif %}
                 </div>
             </div>
+            {% if video %}
+            <p>If the video doesn't play in your browser, download it instead.</p>
+            {% else %}
+            <p>Click an image to see it at full size.</p>
+            {% endif %}
 
             <div class="action-buttons">
-                <a href="{{ url_for('download_file', filename=filename) }}" class="button download">⬇️ Download Denoised</a>
+                <a href="{{ download_url }}" class="button download">⬇️ Download Denoised</a>
                 <a href="{{ url_for('index') }}" class="button">⏪ Process Another Image</a>
             </div>
         </div>
@@ -536,174 +852,761 @@ ERROR_HTML = """
 </html>
 """
 
-# ========== IMAGE PROCESSING ==========
-def denoise_image(input_path, output_path, strength=5, method="nlmeans", grayscale=False):
-    """
-    Apply denoising filters to the image - OPTIMIZED VERSION
-    
-    Parameters:
-    - input_path: Path to the input image
-    - output_path: Path to save the processed image
-    - strength: Denoising strength (1-10)
-    - method: Denoising method to use (nlmeans, bilateral, gaussian)
-    - grayscale: Whether to convert to grayscale
-    """
-    try:
-        # Check if input file exists
-        if not os.path.exists(input_path):
-            raise FileNotFoundError(f"Input file not found: {input_path}")
-            
-        # Read the image
-        image = cv2.imread(input_path)
-        
-        if image is None:
-            raise ValueError(f"Failed to load image from {input_path}")
+# ========== BATCH HTML ==========
+BATCH_HTML = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Batch Denoiser</title>
+    <style>{{ css }}</style>
+</head>
+<body>
+    <div class="container">
+        <h1>🗂️ Batch Image Denoiser</h1>
+        {% if error %}
+        <div class="error-message">{{ error }}</div>
+        {% endif %}
+        <form action="{{ url_for('batch_upload') }}" method="POST" enctype="multipart/form-data">
+            <div class="control-panel">
+                <div class="slider-container">
+                    <label for="images">Images</label>
+                    <input type="file" id="images" name="images" accept="image/*,video/*" multiple style="display: inline-block">
+                </div>
+                <div class="slider-container">
+                    <label for="archive">...or a ZIP archive of images</label>
+                    <input type="file" id="archive" name="archive" accept=".zip" style="display: inline-block">
+                </div>
+                <div class="slider-container">
+                    <label for="strength">Denoising Strength: <span id="strength-value">5</span></label>
+                    <input type="range" id="strength" name="strength" class="slider" min="1" max="10" value="5">
+                </div>
+                <div class="slider-container">
+                    <label for="method">Denoising Method</label>
+                    <select id="method" name="method">
+                        <option value="nlmeans">Non-Local Means Denoising</option>
+                        <option value="bilateral">Bilateral Filter</option>
+                        <option value="gaussian">Gaussian Filter</option>
+                        <option value="auto">Automatic (by measured noise)</option>
+                    </select>
+                </div>
+                <div class="slider-container">
+                    <label for="quality">Processing Mode</label>
+                    <select id="quality" name="quality">
+                        <option value="fast">Fast</option>
+                        <option value="full">Full Resolution</option>
+                    </select>
+                </div>
+                <div class="slider-container">
+                    <label for="format">Output Format</label>
+                    <select id="format" name="format">
+                        <option value="">Same as upload</option>
+                        <option value="jpg">JPEG</option>
+                        <option value="png">PNG</option>
+                        <option value="webp">WebP (smallest)</option>
+                    </select>
+                </div>
+                <div class="slider-container">
+                    <label for="sharpen">Sharpen After Denoising</label>
+                    <select id="sharpen" name="sharpen">
+                        <option value="0">Off</option>
+                        <option value="1">1 (subtle)</option>
+                        <option value="2">2</option>
+                        <option value="3">3</option>
+                        <option value="4">4</option>
+                        <option value="5">5 (strong)</option>
+                    </select>
+                </div>
+                <div class="checkbox-container">
+                    <input type="checkbox" id="grayscale" name="grayscale" value="yes">
+                    <label for="grayscale">Convert to Grayscale</label>
+                </div>
+                <button type="submit" class="button">Upload & Denoise All</button>
+            </div>
+        </form>
+        <a href="{{ url_for('index') }}" class="back-link">⏪ Single image</a>
+    </div>
+    <script>
+        const strengthSlider = document.getElementById('strength');
+        const strengthValue = document.getElementById('strength-value');
+        strengthSlider.addEventListener('input', function() {
+            strengthValue.textContent = this.value;
+        });
+    </script>
+</body>
+</html>
+"""
+
+# ========== BATCH STATUS HTML ==========
+BATCH_STATUS_HTML = """
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Processing Batch</title>
+    <meta charset="UTF-8">
+    <style>{{ css }}</style>
+</head>
+<body>
+    <div class="container">
+        <h1>🗂️ Processing Your Batch</h1>
         
-        # Resize large images to prevent timeouts - REDUCED MAX SIZE FOR FASTER PROCESSING
-        max_dimension = 1000  # Reduced from 1500 to 1000 for faster processing
-        height, width = image.shape[:2]
+        <div class="progress"><div class="progress-bar" id="progress-bar"></div></div>
+        <p id="progress-text">Waiting for the first results...</p>
+        <p>Batch ID: {{ group_id }}</p>
         
-        # If image is too large, resize it more aggressively
-        if width > max_dimension or height > max_dimension:
-            # Calculate scaling factor
-            scale = min(max_dimension / width, max_dimension / height)
-            new_width = int(width * scale)
-            new_height = int(height * scale)
-            
-            # Resize the image using INTER_AREA for downsampling (better quality)
-            image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_AREA)
-            logger.info(f"Resized image from {width}x{height} to {new_width}x{new_height}")
+        <div class="action-buttons">
+            <a href="{{ url_for('batch_download', group_id=group_id) }}" id="download-btn" class="button download" style="display: none">⬇️ Download All (ZIP)</a>
+            <a href="{{ url_for('batch_upload') }}" class="button">⏪ Process Another Batch</a>
+        </div>
+    </div>
+    
+    <script>
+        const groupId = "{{ group_id }}";
         
-        # Convert to grayscale if requested - do this early to speed up processing
-        if grayscale:
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            # Convert back to BGR so we can save as color (but still grayscale)
-            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        function showProgress(data) {
+            document.getElementById('progress-bar').style.width = data.percent + '%';
+            document.getElementById('progress-text').textContent =
+                data.completed + ' of ' + data.total + ' images done' +
+                (data.failed ? ' (' + data.failed + ' failed)' : '');
+            if (data.finished) {
+                document.getElementById('download-btn').style.display = 'inline-block';
+                return true;
+            }
+            return false;
+        }
         
-        # Scale strength parameter for different methods
-        scaled_strength = strength / 10.0  # Convert to 0-1 range
+        const events = new EventSource('/api/batch/' + groupId + '/events');
+        events.addEventListener('progress', function(e) {
+            if (showProgress(JSON.parse(e.data))) {
+                events.close();
+            }
+        });
+    </script>
+</body>
+</html>
+"""
+
+# Worker processes start from a fresh interpreter, which imports the main
+# module again as __mp_main__ when the app is run as a script (python app.py).
+# Only the server process may have a pool, dispatch jobs and clean up
+SERVER_PROCESS = __name__ != '__mp_main__'
+
+# Pool of worker processes that run the actual denoising
+worker_pool = WorkerPool(
+    size=app.config['WORKER_POOL_SIZE'],
+    cv_threads=app.config['WORKER_CV_THREADS'],
+    tile_workers=app.config['TILE_WORKERS'],
+    memory_budget=app.config['WORKER_MEMORY_BUDGET']
+) if SERVER_PROCESS else None
+
+# Name this process uses when claiming jobs from the shared queue
+WORKER_NAME = f"{socket.gethostname()}:{os.getpid()}"
+
+# Set once shutdown has started so no new uploads are accepted
+shutting_down = Event()
+
+# Set when this process enqueues a job so the dispatcher doesn't wait for its next poll
+job_available = Event()
+
+def job_finished(job_id, future):
+    """Record the outcome of a job once its worker process is done"""
+    try:
+        success, message, output, process_time, timings, thumbnails = future.result()
+        logger.info(f"Job {job_id} completed in {process_time:.2f} seconds")
         
-        # Apply denoising based on selected method - OPTIMIZED PARAMETERS
-        if method == "nlmeans":
-            # Non-Local Means Denoising - Further optimized parameters
-            h_luminance = 3 + (7 * scaled_strength)  # Reduced from 10 to 7 to speed up
-            search_window = 11  # Reduced from 15 to 11 to improve performance
-            template_window = 5  # Reduced from 7 to 5
-            
-            if len(image.shape) == 3:  # Color image
-                denoised = cv2.fastNlMeansDenoisingColored(
-                    image, 
-                    None, 
-                    h_luminance,
-                    h_luminance,
-                    template_window, 
-                    search_window
-                )
-            else:  # Grayscale image
-                denoised = cv2.fastNlMeansDenoising(
-                    image, 
-                    None, 
-                    h_luminance,
-                    template_window, 
-                    search_window
-                )
-                
-        elif method == "bilateral":
-            # Bilateral Filter - Optimized parameters
-            d = 5  # Reduced from 7 to 5 for faster processing
-            sigma_color = 10 + (30 * scaled_strength)  # Range 10-40 instead of 10-50
-            sigma_space = 10 + (30 * scaled_strength)  # Range 10-40 instead of 10-50
-            
-            denoised = cv2.bilateralFilter(image, d, sigma_color, sigma_space)
-            
-        else:  # gaussian
-            # Simple Gaussian blur - Fastest option
-            kernel_size = int(3 + (scaled_strength * 2))  # Reduced range from 3-7 to 3-5
-            # Make sure kernel size is odd
-            if kernel_size % 2 == 0:
-                kernel_size += 1
-                
-            sigma = 0.3 + (scaled_strength * 1.2)  # Reduced range
-            
-            denoised = cv2.GaussianBlur(image, (kernel_size, kernel_size), sigma)
+        job = job_store.get_job(job_id)
+        method = job['params'].get('method', 'nlmeans')
+        observe_stages(timings)
+        job_seconds.observe(process_time, method=method)
+        jobs_total.inc(method=method, status='completed' if success else 'failed')
         
-        # Save the processed image with optimized compression
-        if output_path.lower().endswith('.jpg') or output_path.lower().endswith('.jpeg'):
-            # For JPEG, set quality to 95
-            cv2.imwrite(output_path, denoised, [cv2.IMWRITE_JPEG_QUALITY, 95])
-        elif output_path.lower().endswith('.png'):
-            # For PNG, set compression level to 3 (0-9, where 9 is max compression but slow)
-            cv2.imwrite(output_path, denoised, [cv2.IMWRITE_PNG_COMPRESSION, 3])
+        # Update job status
+        if success:
+            thumbnail_paths = {}
+            with timed(timings, 'write'):
+                job_store.put_blob(job['output_path'], output)
+                for kind, thumbnail in thumbnails.items():
+                    path = thumbnail_path(job['filename'], kind)
+                    job_store.put_blob(path, thumbnail)
+                    thumbnail_paths[f'{kind}_thumbnail_path'] = path
+            stage_seconds.observe(timings['write'], stage='write')
+            if job['cache_key']:
+                try:
+                    result_cache.put(job['cache_key'], output)
+                except Exception as e:
+                    logger.error(f"Error caching result of job {job_id}: {str(e)}")
+            job_store.update_job(job_id, status='completed', finished_at=time.time(),
+                                 process_time=f"{process_time:.2f} seconds", **thumbnail_paths)
         else:
-            # For other formats, use default parameters
-            cv2.imwrite(output_path, denoised)
+            job_store.update_job(job_id, status='failed', finished_at=time.time(), error=message)
             
-        return True, "Processing completed successfully"
-        
     except Exception as e:
-        error_msg = f"Error processing image: {str(e)}"
-        logger.error(error_msg)
-        return False, error_msg
+        # The worker process itself died or the job could not be pickled
+        logger.error(f"Worker process error: {str(e)}")
+        job_store.update_job(job_id, status='failed', finished_at=time.time(),
+                             error=f"Worker process error: {str(e)}")
+
+def thumbnail_path(filename, kind):
+    """Blob name of a job's 'input' or 'output' thumbnail"""
+    name = os.path.splitext(filename)[0]
+    return os.path.join(app.config['PROCESSED_FOLDER'], 'thumbnails', f"{name}_{kind}.jpg")
+
+def preview_finished(job_id, preview_path, preview):
+    """Publish the preview a worker sent while the job is still running"""
+    job_store.put_blob(preview_path, preview)
+    # The job may already be done if the preview arrived late
+    job_store.update_job(job_id, if_status='processing', status='preview', preview_path=preview_path)
 
-# Background worker thread to process images - IMPROVED VERSION
+# Background dispatcher thread that hands queued jobs to the worker pool
 def process_image_queue():
-    while True:
+    while not shutting_down.is_set():
+        job = None
         try:
-            # Get a job from the queue
-            job_id, input_path, output_path, params = app.config['PROCESSING_QUEUE'].get()
+            # Wait until one of the worker processes is free
+            if not worker_pool.acquire(timeout=1):
+                continue
             
-            # Update job status
-            processing_jobs[job_id]['status'] = 'processing'
-            start_time = time.time()
+            # Take the next job from the shared queue
+            job = job_store.claim_next_job(WORKER_NAME)
+            if job is None:
+                worker_pool.release()
+                # Jobs enqueued by other processes are picked up on the next poll
+                job_available.wait(app.config['JOB_POLL_INTERVAL'])
+                job_available.clear()
+                continue
             
-            # Process the image
-            success, message = denoise_image(
-                input_path, 
-                output_path, 
-                strength=params.get('strength', 5),
-                method=params.get('method', 'nlmeans'),
-                grayscale=params.get('grayscale', False)
-            )
+            queue_wait_seconds.observe(job['started_at'] - job['created_at'])
             
-            # Calculate processing time
-            process_time = time.time() - start_time
-            logger.info(f"Job {job_id} completed in {process_time:.2f} seconds")
+            # The worker gets the encoded upload straight from the job store
+            timings = {}
+            with timed(timings, 'read'):
+                data = job_store.get_blob(job['input_path'])
+            observe_stages(timings)
+            if data is None:
+                raise FileNotFoundError(f"Input image not found: {job['input_path']}")
             
-            # Update job status
-            if success:
-                processing_jobs[job_id]['status'] = 'completed'
-                processing_jobs[job_id]['process_time'] = f"{process_time:.2f} seconds"
+            output_ext = os.path.splitext(job['output_path'])[1]
+            if is_video(job['input_path']):
+                task = (run_video_job, data, os.path.splitext(job['input_path'])[1], output_ext, job['params'])
+                preview = False
             else:
-                processing_jobs[job_id]['status'] = 'failed'
-                processing_jobs[job_id]['error'] = message
+                # Someone is watching interactive jobs, so slow ones show a preview first
+                preview = job['priority_class'] == 'interactive' and \
+                    (job['cost'] or 0) >= app.config['PREVIEW_MIN_COST']
+                task = (run_denoise_job, data, output_ext, job['params'], preview)
+            # Named like the result, since the preview is encoded in the same format
+            preview_path = os.path.join(app.config['PROCESSED_FOLDER'], 'previews',
+                                        os.path.basename(job['output_path']))
             
-            # Mark the task as done
-            app.config['PROCESSING_QUEUE'].task_done()
+            try:
+                # Waits here if the job doesn't fit in the memory left by the running ones
+                worker_pool.submit(
+                    *task,
+                    callback=partial(job_finished, job['job_id']),
+                    on_progress=partial(preview_finished, job['job_id'], preview_path) if preview else None,
+                    memory=job['memory'] or 0
+                )
+            except RuntimeError:
+                # The pool is shut down, which concurrent.futures does on interpreter
+                # exit before our atexit hook runs. Put the job back for the next start
+                job_store.update_job(job['job_id'], status='pending', started_at=None, claimed_by=None)
+                logger.info("Worker pool is shut down, dispatcher stopping")
+                return
             
         except Exception as e:
-            logger.error(f"Worker thread error: {str(e)}")
-            # If we get here, something went wrong with the worker itself
-            if job_id in processing_jobs:
-                processing_jobs[job_id]['status'] = 'failed'
-                processing_jobs[job_id]['error'] = f"Worker thread error: {str(e)}"
-            
-            # Mark the task as done even if it failed
-            app.config['PROCESSING_QUEUE'].task_done()
+            logger.error(f"Dispatcher thread error: {str(e)}")
+            if job is None:
+                # Don't spin if the store itself is failing
+                worker_pool.release()
+                time.sleep(app.config['JOB_POLL_INTERVAL'])
+            else:
+                job_store.update_job(job['job_id'], status='failed', finished_at=time.time(),
+                                     error=f"Dispatcher thread error: {str(e)}")
 
-# Start the worker thread
+# Start the dispatcher thread
 worker_thread = Thread(target=process_image_queue, daemon=True)
-worker_thread.start()
+if SERVER_PROCESS:
+    worker_thread.start()
+
+def shutdown_workers():
+    """Stop taking new jobs and let the running ones finish"""
+    if shutting_down.is_set():
+        return
+    shutting_down.set()
+    job_available.set()
+    logger.info("Waiting for running jobs before shutdown")
+    
+    # Pending jobs stay in the job store for the other workers or the next start
+    worker_thread.join(timeout=app.config['WORKER_DRAIN_TIMEOUT'])
+    worker_pool.shutdown(wait=True)
+    logger.info("Worker pool shut down")
+
+if SERVER_PROCESS:
+    atexit.register(shutdown_workers)
+
+# ========== JOB SUBMISSION ==========
+ALLOWED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff', '.mp4', '.avi', '.mov', '.mkv')
+UNSUPPORTED_FORMAT_MESSAGE = ("Unsupported file format. Please upload a PNG, JPG, JPEG, GIF, BMP, or TIFF image "
+                              "or an MP4, AVI, MOV, or MKV video.")
+
+def check_upload_header(filename, header, complete):
+    """
+    Check the first bytes of an upload
+    
+    Raises UploadRejected if they aren't those of a supported image or
+    video, or of a video where the extension promises an image or the other
+    way round, and if an image has more than MAX_IMAGE_PIXELS pixels.
+    Returns True once decided, or False while more bytes are needed;
+    complete means there are no more. Images whose dimensions aren't found
+    in the header are left for the decoder to judge.
+    """
+    image_format = sniff_format(header)
+    if is_video(filename):
+        valid = sniff_video_format(header) is not None or image_format == '.gif'
+    else:
+        valid = image_format is not None
+    if not valid:
+        # Magic bytes are at most 12 bytes long
+        if len(header) < 12 and not complete:
+            return False
+        raise UploadRejected(f"{secure_filename(filename)} is not a valid image or video, "
+                             f"or its contents don't match its extension.")
+    if image_format is None:
+        return True
+    
+    size = read_image_size(header)
+    if size is None:
+        return complete
+    width, height = size
+    if width * height > app.config['MAX_IMAGE_PIXELS']:
+        raise UploadRejected(f"Image is too large ({width}x{height}). Images may have at most "
+                             f"{app.config['MAX_IMAGE_PIXELS'] / 1e6:g} megapixels.", 413)
+    return True
+
+def read_upload(file):
+    """Return the bytes of an uploaded file and their content digest"""
+    if isinstance(file.stream, UploadStream):
+        # Hashed while it streamed in
+        return file.stream.finish()
+    data = file.read()
+    return data, content_digest(data)
+
+def still_gif_as_png(filename, data, digest=None):
+    """
+    Turn a GIF with a single frame into a PNG, so it is denoised as an image
+    
+    GIFs go down the video path (see is_video()) to keep all their frames,
+    which only makes sense for animated ones. Returns the filename, data and
+    content digest to use from here on.
+    """
+    if os.path.splitext(filename)[1].lower() != '.gif' or is_animated_gif(data):
+        return filename, data, digest
+    try:
+        image = decode_image(data)
+    except ValueError:
+        # Left for the worker to report
+        return filename, data, digest
+    data = encode_image(image, '.png')
+    return os.path.splitext(filename)[0] + '.png', data, content_digest(data)
+
+def unique_filename(original_filename):
+    """Secure an uploaded filename and add a timestamp and random suffix to prevent overwrites"""
+    # Secure the filename to prevent directory traversal attacks
+    filename = secure_filename(original_filename)
+    
+    # Add timestamp to filename to prevent overwrites, and a random suffix
+    # since uploads of the same name can arrive within the same second
+    name, ext = os.path.splitext(filename)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return f"{name}_{timestamp}_{uuid.uuid4().hex[:8]}{ext}"
+
+def get_processing_params(form):
+    """Read the image processing parameters from a submitted form"""
+    # Results are written in the upload's format unless another one is asked for
+    output_format = form.get('format') or None
+    if output_format is not None:
+        output_format = '.' + output_format.lower().lstrip('.')
+        if output_format == '.jpeg':
+            output_format = '.jpg'
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported output format {form.get('format')}. "
+                             f"Choose one of {', '.join(fmt[1:] for fmt in OUTPUT_FORMATS)}.")
+    output_quality = int(form['output_quality']) if form.get('output_quality') else None
+    if output_quality is not None and not 1 <= output_quality <= 100:
+        raise ValueError("Output quality must be between 1 and 100.")
+    method = form.get('method', 'nlmeans')
+    if method not in METHODS:
+        raise ValueError(f"Unknown denoising method {method}.")
+    strength = int(form.get('strength', 5))
+    _, min_strength, max_strength = STAGE_VALUES['nlmeans']
+    if not min_strength <= strength <= max_strength:
+        raise ValueError(f"Strength must be between {min_strength} and {max_strength}.")
+    sharpen = int(form.get('sharpen') or 0)
+    if not 0 <= sharpen <= STAGE_VALUES['sharpen'][2]:
+        raise ValueError(f"Sharpening intensity must be between 0 (off) and {STAGE_VALUES['sharpen'][2]}.")
+    
+    params = {
+        'strength': strength,
+        'method': method,
+        'grayscale': form.get('grayscale') == 'yes',
+        # Fast mode downscales large images, full mode keeps every pixel
+        'max_dimension': None if form.get('quality') == 'full' else MAX_DIMENSION,
+        'output_format': output_format,
+        # Quality of JPEG, WebP and AVIF results (None for the format's default)
+        'output_quality': output_quality,
+        # Sharpening intensity after denoising, 0 for none
+        'sharpen': sharpen,
+        # Seconds the auto method may spend choosing within
+        'time_budget': app.config['AUTO_TIME_BUDGET'] if method == 'auto' else None,
+        # Stages given explicitly, e.g. pipeline=grayscale,nlmeans:6,sharpen:2,
+        # instead of the ones the options above make
+        'pipeline': None
+    }
+    if form.get('pipeline'):
+        stages = parse_pipeline(form['pipeline'])
+        denoise = next(((name, value) for name, value in stages if name in METHODS), None)
+        # The usual options still describe the job for the previews and metrics
+        params.update(
+            pipeline=stages,
+            method=denoise[0] if denoise else 'none',
+            strength=denoise[1] if denoise else params['strength'],
+            grayscale=any(name == 'grayscale' for name, _ in stages),
+            max_dimension=decode_options(stages)[1],
+            sharpen=0,
+            time_budget=None
+        )
+    return params
+
+def job_pipeline(params):
+    """Stages an image job runs"""
+    return params.get('pipeline') or build_pipeline(params['strength'], params['method'], params['grayscale'],
+                                                    params['max_dimension'], params.get('sharpen', 0),
+                                                    params.get('time_budget'))
+
+def check_video_params(filename, params):
+    """Raise ValueError if a video is asked for processing only images get"""
+    if is_video(filename) and (params['pipeline'] or params['sharpen'] or params['method'] == 'auto'):
+        raise ValueError("Videos can only be denoised with a fixed method. Auto, sharpening and pipelines "
+                         "are for images.")
+
+def result_cache_key(data, filename, params, digest=None):
+    """Cache key for an upload processed with the given parameters"""
+    ext = os.path.splitext(filename)[1]
+    if digest is None:
+        digest = content_digest(data)
+    return ResultCache.make_key(digest, format=ext.lower(), **params)
+
+def output_filename(filename, params):
+    """Name of a job's result; it may be written in another format or container"""
+    name, ext = os.path.splitext(filename)
+    if is_video(filename):
+        return name + video_output_ext(ext)
+    return name + (params['output_format'] or ext)
+
+def record_cached_job(data, output, filename, params, cache_key, group_id=None):
+    """Create an already completed job for a result found in the cache"""
+    # Create a job ID using timestamp
+    job_id = f"{int(time.time())}_{filename}"
+    input_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    output_path = os.path.join(app.config['PROCESSED_FOLDER'], output_filename(filename, params))
+    
+    logger.info(f"Job {job_id} served from the result cache")
+    jobs_total.inc(method=params['method'], status='cached')
+    job_store.put_blob(input_path, data)
+    job_store.put_blob(output_path, output)
+    job_store.create_job(job_id, filename, input_path, output_path, params,
+                         status='completed', cache_key=cache_key, group_id=group_id,
+                         finished_at=time.time(), process_time="0.00 seconds (cached)")
+    return job_id
+
+class QueueFull(Exception):
+    """Raised when a job is refused because the queue is saturated"""
+    
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        # Whole seconds for the Retry-After header
+        self.retry_after = max(1, math.ceil(retry_after))
+
+def client_id():
+    """Identify the client of the current request for the per-client limits"""
+    # ProxyFix sets remote_addr from the trusted hops of X-Forwarded-For only
+    return request.remote_addr
+
+def job_estimates(data, filename, params):
+    """
+    Estimate the processing cost and peak memory in bytes of an upload
+    
+    Both come from the header, so a large image isn't decoded just to find
+    out that it is too large.
+    """
+    if is_video(filename):
+        options = (params['method'], params['max_dimension'], params['grayscale'])
+        info = read_video_info_bytes(data, os.path.splitext(filename)[1])
+        if info is None:
+            return 0.0, 0
+        return estimate_video_cost(info, *options), estimate_video_memory(info, *options)
+    
+    stages = job_pipeline(params)
+    grayscale, max_dimension = decode_options(stages)
+    size = read_image_size(data)
+    if size is None:
+        # Header not understood; decode it, and leave broken images for the worker to report
+        try:
+            height, width = decode_image(data, grayscale).shape[:2]
+        except ValueError:
+            return 0.0, 0
+    else:
+        width, height = size
+    return estimate_pipeline_cost(width, height, stages), \
+        estimate_pipeline_memory(width, height, stages, decode_scale(data, max_dimension))
+
+def wait_seconds(cost):
+    """Seconds all workers together need for the given amount of estimated work"""
+    return cost / app.config['QUEUE_CAPACITY']
+
+def admit_job(cost, client, jobs=1):
+    """
+    Raise QueueFull if jobs of the given total cost can't be accepted right now
+    
+    The check and the insert aren't atomic, so concurrent uploads can
+    overshoot the limits slightly, which is fine for backpressure.
+    """
+    load = job_store.queue_load(client)
+    if not load['jobs']:
+        # An empty queue takes anything
+        return
+    average_cost = load['cost'] / load['jobs']
+    
+    if load['jobs'] + jobs > app.config['QUEUE_MAX_JOBS']:
+        excess = load['jobs'] + jobs - app.config['QUEUE_MAX_JOBS']
+        raise QueueFull("The server is busy. Please try again later.", wait_seconds(excess * average_cost))
+    queue_wait = wait_seconds(load['cost'] + cost)
+    if queue_wait > app.config['QUEUE_MAX_WAIT']:
+        raise QueueFull("The server is busy. Please try again later.",
+                        queue_wait - app.config['QUEUE_MAX_WAIT'])
+    
+    if load['client_jobs'] + jobs > app.config['CLIENT_MAX_JOBS']:
+        excess = load['client_jobs'] + jobs - app.config['CLIENT_MAX_JOBS']
+        client_average_cost = load['client_cost'] / load['client_jobs'] if load['client_jobs'] else average_cost
+        raise QueueFull("You have too many images waiting. Please try again when they are done.",
+                        wait_seconds(excess * client_average_cost))
+    client_wait = wait_seconds(load['client_cost'] + cost)
+    if load['client_jobs'] and client_wait > app.config['CLIENT_MAX_WAIT']:
+        raise QueueFull("You have too many images waiting. Please try again when they are done.",
+                        client_wait - app.config['CLIENT_MAX_WAIT'])
+
+def admit_batch(cost, jobs, client):
+    """
+    Raise QueueFull if a batch of jobs can't be accepted right now, and
+    ValueError if it is too big to ever be accepted, so retrying is no use
+    """
+    max_jobs = min(app.config['QUEUE_MAX_JOBS'], app.config['CLIENT_MAX_JOBS'])
+    max_wait = min(app.config['QUEUE_MAX_WAIT'], app.config['CLIENT_MAX_WAIT'])
+    if jobs > max_jobs or wait_seconds(cost) > max_wait:
+        raise ValueError(f"This batch is too big to queue at once: it holds {jobs} images needing about "
+                         f"{wait_seconds(cost):.0f} seconds of processing, and at most {max_jobs} images "
+                         f"or {max_wait:.0f} seconds can wait at a time. Please split it into smaller batches.")
+    admit_job(cost, client, jobs)
+
+def submit_job(data, filename, params, cache_key=None, group_id=None, estimates=None,
+               priority='interactive', hold=False):
+    """
+    Store an upload and add it to the processing queue, returning the job id
+    
+    estimates is the (cost, memory) pair of job_estimates() if the caller
+    already has it. priority is one of the PRIORITY_CLASSES. Raises QueueFull
+    if the queue can't take the job, and ValueError if no worker has the
+    memory to process it. With hold set the job is stored as 'held' without
+    checking the queue limits, for the caller to admit and release later.
+    """
+    cost, memory = estimates or job_estimates(data, filename, params)
+    if not worker_pool.fits(memory):
+        jobs_total.inc(method=params['method'], status='rejected')
+        raise ValueError(f"{filename} is too large to process with these settings. "
+                         "Please use fast mode or a smaller image.")
+    client = client_id()
+    if not hold:
+        try:
+            admit_job(cost, client)
+        except QueueFull:
+            jobs_total.inc(method=params['method'], status='rejected')
+            raise
+    
+    # Create a job ID using timestamp
+    job_id = f"{int(time.time())}_{filename}"
+    
+    # Blob names; large images are spilled to these paths
+    input_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    output_path = os.path.join(app.config['PROCESSED_FOLDER'], output_filename(filename, params))
+    
+    # Add job to the shared job store, which is also the processing queue
+    timings = {}
+    with timed(timings, 'upload_save'):
+        job_store.put_blob(input_path, data)
+    observe_stages(timings)
+    job_store.create_job(job_id, filename, input_path, output_path, params,
+                         cache_key=cache_key, group_id=group_id, cost=cost, memory=memory, client=client,
+                         priority=app.config['PRIORITY_CLASSES'][priority], priority_class=priority,
+                         status='held' if hold else 'pending')
+    if not hold:
+        job_available.set()
+    return job_id
+
+def iter_batch_files(files):
+    """Yield (filename, data) for every file of a batch upload, unpacking ZIP archives"""
+    for file in files.getlist('images'):
+        if file.filename:
+            data = file.read()
+            if len(data) > app.config['MAX_CONTENT_LENGTH']:
+                raise ValueError(f"{file.filename} is too large. Maximum file size is 16MB.")
+            yield file.filename, data
+    
+    archive = files.get('archive')
+    if archive and archive.filename:
+        with zipfile.ZipFile(archive.stream) as zip_file:
+            for info in zip_file.infolist():
+                name = os.path.basename(info.filename)
+                # Skip folders and metadata such as __MACOSX/._photo.jpg
+                if info.is_dir() or not name or name.startswith('.'):
+                    continue
+                # Same per-image limit as single uploads, which also stops zip bombs
+                if info.file_size > app.config['MAX_CONTENT_LENGTH']:
+                    raise ValueError(f"{name} is too large. Maximum file size is 16MB.")
+                yield name, zip_file.read(info)
+
+def create_batch(files, form):
+    """
+    Queue every image of a batch upload as one job group
+    
+    Returns the group id, the job ids and the names of skipped files. The
+    jobs are held until the whole batch is in, and then admitted to the
+    queue together; if the queue can't take them all they are dropped again
+    and QueueFull is raised, so a batch is accepted entirely or not at all.
+    """
+    params = get_processing_params(form)
+    token = uuid.uuid4().hex[:8]
+    group_id = f"batch_{int(time.time())}_{token}"
+    job_ids = []
+    held_ids = []
+    held_cost = 0.0
+    skipped = []
+    
+    try:
+        for index, (name, data) in enumerate(iter_batch_files(files)):
+            # The token and index keep names unique within and across batches
+            filename = unique_filename(f"{token}_{index:03d}_{name}")
+            if not filename.lower().endswith(ALLOWED_EXTENSIONS):
+                skipped.append(name)
+                continue
+            try:
+                check_upload_header(filename, data[:app.config['UPLOAD_SNIFF_BYTES']], complete=True)
+                filename, data, _ = still_gif_as_png(filename, data)
+                check_video_params(filename, params)
+            except (UploadRejected, ValueError):
+                skipped.append(name)
+                continue
+            if len(job_ids) >= app.config['BATCH_MAX_FILES']:
+                raise ValueError(f"Too many images. A batch can hold at most {app.config['BATCH_MAX_FILES']}.")
+            
+            cache_key = result_cache_key(data, filename, params)
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                job_ids.append(record_cached_job(data, cached, filename, params, cache_key, group_id))
+            else:
+                cost, memory = job_estimates(data, filename, params)
+                job_id = submit_job(data, filename, params, cache_key, group_id, estimates=(cost, memory),
+                                    priority='batch', hold=True)
+                job_ids.append(job_id)
+                held_ids.append(job_id)
+                held_cost += cost
+        
+        if held_ids:
+            try:
+                admit_batch(held_cost, len(held_ids), client_id())
+            except (QueueFull, ValueError):
+                jobs_total.inc(len(held_ids), method=params['method'], status='rejected')
+                raise
+            for job_id in held_ids:
+                job_store.update_job(job_id, if_status='held', status='pending')
+            job_available.set()
+    except Exception:
+        if job_ids:
+            job_store.delete_jobs(job_ids)
+        raise
+    
+    if not job_ids:
+        raise ValueError("No supported images found. Please upload PNG, JPG, JPEG, GIF, BMP, or TIFF images "
+                         "or MP4, AVI, MOV, or MKV videos.")
+    
+    logger.info(f"Batch {group_id} created with {len(job_ids)} jobs")
+    return group_id, job_ids, skipped
+
+def batch_progress(group_id, jobs=None):
+    """Aggregate progress of a job group, or None if the group doesn't exist"""
+    if jobs is None:
+        jobs = job_store.list_jobs(group_id)
+    if not jobs:
+        return None
+    
+    counts = {'pending': 0, 'processing': 0, 'completed': 0, 'failed': 0}
+    for job in jobs:
+        # A job showing a preview is still processing
+        status = 'processing' if job['status'] == 'preview' else job['status']
+        counts[status] = counts.get(status, 0) + 1
+    done = counts['completed'] + counts['failed']
+    
+    return dict(
+        counts,
+        group_id=group_id,
+        total=len(jobs),
+        percent=int(100 * done / len(jobs)),
+        finished=done == len(jobs),
+        jobs=[{
+            'job_id': job['job_id'],
+            'filename': job['filename'],
+            'status': job['status'],
+            'message': (job['error'] or '') if job['status'] == 'failed' else ''
+        } for job in jobs]
+    )
+
+class ZipStream:
+    """Write-only file object that collects what zipfile writes, for streaming"""
+    
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def take(self):
+        """Return and forget everything written so far"""
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
 
 # ========== ROUTES ==========
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
-        # Check if image file was uploaded
-        if 'image' not in request.files:
+        # Don't accept new work while the workers are draining
+        if shutting_down.is_set():
+            return render_template_string(INDEX_HTML, css=CSS_STYLE,
+                                        error="The server is restarting. Please try again in a moment.")
+
+        # Check if image file was uploaded. Its format and size are checked
+        # while it streams in (see DenoiserRequest)
+        try:
+            file = request.files.get('image')
+        except UploadRejected as e:
+            return render_template_string(INDEX_HTML, css=CSS_STYLE, error=str(e)), e.status
+        if file is None:
             return render_template_string(INDEX_HTML, css=CSS_STYLE, error="No file selected")
         
-        file = request.files['image']
-        
         # If user doesn't select a file, browser submits an empty file
         if file.filename == '':
             return render_template_string(INDEX_HTML, css=CSS_STYLE, error="No file selected")
@@ -711,56 +1614,33 @@ def index():
         # Process the image if it exists
         if file:
             try:
-                # Secure the filename to prevent directory traversal attacks
-                filename = secure_filename(file.filename)
+                filename = unique_filename(file.filename)
                 
-                # Add timestamp to filename to prevent overwrites
-                name, ext = os.path.splitext(filename)
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                filename = f"{name}_{timestamp}{ext}"
-                
-                # Check if the file is an image
-                if not filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff')):
-                    return render_template_string(INDEX_HTML, css=CSS_STYLE, 
-                                                error="Unsupported file format. Please upload a PNG, JPG, JPEG, GIF, BMP, or TIFF image.")
-                
-                # Define file paths
-                input_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                output_path = os.path.join(app.config['PROCESSED_FOLDER'], filename)
-                
-                # Save the uploaded file
-                file.save(input_path)
+                # The upload is already in memory, and hashed
+                data, digest = read_upload(file)
+                filename, data, digest = still_gif_as_png(filename, data, digest)
                 
                 # Get image processing parameters
-                strength = int(request.form.get('strength', 5))
-                method = request.form.get('method', 'nlmeans')
-                grayscale = request.form.get('grayscale') == 'yes'
-                
-                # Create a job ID using timestamp
-                job_id = f"{int(time.time())}_{filename}"
+                params = get_processing_params(request.form)
+                check_video_params(filename, params)
                 
-                # Add job to tracking dictionary
-                processing_jobs[job_id] = {
-                    'status': 'pending',
-                    'filename': filename,
-                    'created_at': time.time()
-                }
+                # Identical upload and settings processed before? Serve the cached result
+                cache_key = result_cache_key(data, filename, params, digest)
+                cached = result_cache.get(cache_key)
+                if cached is not None:
+                    job_id = record_cached_job(data, cached, filename, params, cache_key)
+                    return redirect(url_for('check_status', job_id=job_id))
                 
-                # Add job to processing queue
-                app.config['PROCESSING_QUEUE'].put((
-                    job_id,
-                    input_path,
-                    output_path,
-                    {
-                        'strength': strength,
-                        'method': method,
-                        'grayscale': grayscale
-                    }
-                ))
+                job_id = submit_job(data, filename, params, cache_key)
                 
                 # Redirect to processing page
                 return render_template_string(PROCESSING_HTML, job_id=job_id, css=CSS_STYLE)
                 
+            except UploadRejected as e:
+                return render_template_string(INDEX_HTML, css=CSS_STYLE, error=str(e)), e.status
+            except QueueFull as e:
+                return render_template_string(INDEX_HTML, css=CSS_STYLE, error=str(e)), 429, \
+                    {'Retry-After': str(e.retry_after)}
             except Exception as e:
                 logger.error(f"Error handling upload: {str(e)}")
                 return render_template_string(INDEX_HTML, css=CSS_STYLE, error=f"Error processing upload: {str(e)}")
@@ -768,77 +1648,470 @@ def index():
     # Render the index page for GET requests
     return render_template_string(INDEX_HTML, css=CSS_STYLE)
 
+@app.route('/api/denoise', methods=['POST'])
+def api_denoise():
+    """
+    Denoise an uploaded image, returning the result directly when it's cheap
+    
+    Jobs whose estimated cost is below SYNC_COST_THRESHOLD seconds and whose
+    memory is below INLINE_MAX_MEMORY are run inline and the processed image
+    is the response body. Anything more expensive is queued like an upload
+    from the web page, and the response is 202 with the job id and the URLs
+    to poll and fetch the result from. Images too large for the worker
+    memory budget get 413.
+    Queued jobs can be sent with priority=batch to run after interactive ones.
+    Instead of the method, strength, grayscale, quality and sharpen fields,
+    images can be given the stages to run as e.g.
+    pipeline=grayscale,nlmeans:6,sharpen:2 (see parse_pipeline()).
+    """
+    if shutting_down.is_set():
+        return jsonify({'error': 'The server is restarting. Please try again in a moment.'}), 503
+    
+    # Unsupported, corrupt and oversized images are refused while they stream in
+    try:
+        file = request.files.get('image')
+    except UploadRejected as e:
+        return jsonify({'error': str(e)}), e.status
+    if file is None or file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
+    
+    filename = unique_filename(file.filename)
+    try:
+        data, digest = read_upload(file)
+    except UploadRejected as e:
+        return jsonify({'error': str(e)}), e.status
+    filename, data, digest = still_gif_as_png(filename, data, digest)
+    
+    try:
+        params = get_processing_params(request.form)
+        check_video_params(filename, params)
+    except ValueError as e:
+        return jsonify({'error': f"Invalid parameters: {str(e)}"}), 400
+    
+    # Scripts doing bulk work can ask to yield to people waiting on a page
+    priority = request.form.get('priority', 'interactive')
+    if priority not in app.config['PRIORITY_CLASSES']:
+        return jsonify({'error': f"Invalid priority: {priority}"}), 400
+    
+    ext = os.path.splitext(output_filename(filename, params))[1]
+    mimetype = mimetypes.guess_type(output_filename(filename, params))[0] or 'application/octet-stream'
+    
+    # Repeated request? Answer from the cache
+    cache_key = result_cache_key(data, filename, params, digest)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        jobs_total.inc(method=params['method'], status='cached')
+        return Response(cached, mimetype=mimetype, headers={'X-Cache': 'hit'})
+    
+    cost, memory = job_estimates(data, filename, params)
+    
+    # Videos always go through the queue
+    if not is_video(filename) and cost <= app.config['SYNC_COST_THRESHOLD'] and \
+            memory <= app.config['INLINE_MAX_MEMORY']:
+        # Cheap enough to skip the queue and the status polling
+        timings = {}
+        stages = job_pipeline(params)
+        try:
+            with timed(timings, 'decode'):
+                image = decode_image(data, *decode_options(stages))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        start_time = time.time()
+        try:
+            denoised = run_pipeline(image, stages, app.config['TILE_WORKERS'], timings)
+            with timed(timings, 'encode'):
+                output = encode_image(denoised, ext, params['output_quality'])
+        except Exception as e:
+            logger.error(f"Error processing image inline: {str(e)}")
+            jobs_total.inc(method=params['method'], status='failed')
+            return jsonify({'error': f"Error processing image: {str(e)}"}), 500
+        process_time = time.time() - start_time
+        observe_stages(timings)
+        job_seconds.observe(process_time, method=params['method'])
+        jobs_total.inc(method=params['method'], status='inline')
+        
+        try:
+            result_cache.put(cache_key, output)
+        except Exception as e:
+            logger.error(f"Error caching inline result: {str(e)}")
+        
+        return Response(output, mimetype=mimetype, headers={
+            'X-Cache': 'miss',
+            'X-Process-Time': f"{process_time:.3f}"
+        })
+    
+    # Too expensive to do inline, hand it to the worker pool
+    try:
+        job_id = submit_job(data, filename, params, cache_key, estimates=(cost, memory), priority=priority)
+    except QueueFull as e:
+        return jsonify({'error': str(e), 'retry_after': e.retry_after}), 429, \
+            {'Retry-After': str(e.retry_after)}
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 413
+    return jsonify({
+        'job_id': job_id,
+        'status': 'pending',
+        'estimated_cost': round(cost, 2),
+        'status_url': url_for('api_status', job_id=job_id),
+        'result_url': url_for('processed_file', filename=output_filename(filename, params))
+    }), 202
+
+@app.route('/batch', methods=['GET', 'POST'])
+def batch_upload():
+    """Upload many images (or a ZIP archive) as one batch"""
+    if request.method == 'POST':
+        if shutting_down.is_set():
+            return render_template_string(BATCH_HTML, css=CSS_STYLE,
+                                        error="The server is restarting. Please try again in a moment.")
+        try:
+            group_id, _, skipped = create_batch(request.files, request.form)
+            if skipped:
+                logger.info(f"Batch {group_id} skipped unsupported files: {', '.join(skipped)}")
+            return redirect(url_for('batch_status', group_id=group_id))
+        except QueueFull as e:
+            return render_template_string(BATCH_HTML, css=CSS_STYLE, error=str(e)), 429, \
+                {'Retry-After': str(e.retry_after)}
+        except (ValueError, zipfile.BadZipFile) as e:
+            return render_template_string(BATCH_HTML, css=CSS_STYLE, error=str(e))
+        except Exception as e:
+            logger.error(f"Error handling batch upload: {str(e)}")
+            return render_template_string(BATCH_HTML, css=CSS_STYLE, error=f"Error processing upload: {str(e)}")
+    
+    return render_template_string(BATCH_HTML, css=CSS_STYLE)
+
+@app.route('/api/batch', methods=['POST'])
+def api_batch():
+    """Queue a batch upload and return the group id and its URLs"""
+    if shutting_down.is_set():
+        return jsonify({'error': 'The server is restarting. Please try again in a moment.'}), 503
+    try:
+        group_id, job_ids, skipped = create_batch(request.files, request.form)
+    except QueueFull as e:
+        return jsonify({'error': str(e), 'retry_after': e.retry_after}), 429, \
+            {'Retry-After': str(e.retry_after)}
+    except (ValueError, zipfile.BadZipFile) as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'group_id': group_id,
+        'job_ids': job_ids,
+        'skipped': skipped,
+        'status_url': url_for('api_batch_status', group_id=group_id),
+        'download_url': url_for('batch_download', group_id=group_id)
+    }), 202
+
+@app.route('/batch/<group_id>')
+def batch_status(group_id):
+    """Progress page of a batch"""
+    if not job_store.list_jobs(group_id):
+        return render_template_string(ERROR_HTML, css=CSS_STYLE,
+                                     error_message="Batch not found. It may have expired or been removed.")
+    return render_template_string(BATCH_STATUS_HTML, group_id=group_id, css=CSS_STYLE)
+
+@app.route('/api/batch/<group_id>')
+def api_batch_status(group_id):
+    """Aggregate progress of a batch and the status of each job"""
+    progress = batch_progress(group_id)
+    if progress is None:
+        return jsonify({'status': 'not_found', 'message': 'Batch not found'}), 404
+    return jsonify(progress)
+
+@app.route('/api/batch/<group_id>/events')
+def batch_events(group_id):
+    """Server-Sent Events stream of a batch's progress, like /api/events/<job_id>"""
+    def generate():
+        deadline = time.time() + app.config['STATUS_MAX_WAIT']
+        yield "retry: 1000\n\n"
+        while True:
+            jobs = job_store.list_jobs(group_id)
+            progress = batch_progress(group_id, jobs)
+            if progress is None:
+                yield f"event: progress\ndata: {json.dumps({'status': 'not_found'})}\n\n"
+                return
+            del progress['jobs']
+            yield f"event: progress\ndata: {json.dumps(progress)}\n\n"
+            remaining = deadline - time.time()
+            if progress['finished'] or remaining <= 0:
+                return
+            # Sleep until the oldest unfinished job changes state
+            waiting = next(job for job in jobs if job['status'] in ('pending', 'processing', 'preview'))
+            job_store.wait_for_update(waiting['job_id'], waiting['status'], remaining)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/batch/<group_id>/download')
+def batch_download(group_id):
+    """Stream a ZIP archive of every finished result of a batch"""
+    jobs = [job for job in job_store.list_jobs(group_id) if job['status'] == 'completed']
+    if not jobs:
+        return render_template_string(ERROR_HTML, css=CSS_STYLE,
+                                     error_message="No finished images found for this batch.")
+    
+    def generate():
+        stream = ZipStream()
+        # Images are already compressed, so store them as they are
+        with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as archive:
+            for job in jobs:
+                data = job_store.get_blob(job['output_path'])
+                if data is None:
+                    continue
+                archive.writestr(f"denoised_{os.path.basename(job['output_path'])}", data)
+                # Send each image as soon as it's in the archive
+                yield stream.take()
+        yield stream.take()
+    
+    return Response(generate(), mimetype='application/zip', headers={
+        'Content-Disposition': f"attachment; filename=denoised_{group_id}.zip"
+    })
+
+def job_status_payload(job):
+    """Status of a job as returned by the status API and event stream"""
+    if job is None:
+        return {'status': 'not_found', 'message': 'Job not found'}
+    payload = {
+        'status': job['status'],
+        'message': (job['error'] or '') if job['status'] == 'failed' else '',
+        'process_time': job['process_time'] or ''
+    }
+    
+    # Seconds until the result is expected, from the estimated cost of the
+    # jobs ahead of this one
+    if job['status'] == 'completed':
+        payload['result_url'] = blob_url('processed_file', job['output_path'],
+                                         filename=os.path.basename(job['output_path']))
+    elif job['status'] == 'pending':
+        position = job_store.queue_position(job['job_id'])
+        if position is not None:
+            jobs_ahead, cost_ahead = position
+            payload['queue_position'] = jobs_ahead
+            payload['estimated_wait'] = round(wait_seconds(cost_ahead) + (job['cost'] or 0), 1)
+    elif job['status'] in ('processing', 'preview'):
+        if job['status'] == 'preview':
+            payload['preview_url'] = blob_url('preview_file', job['preview_path'],
+                                              filename=os.path.basename(job['preview_path']))
+        payload['estimated_wait'] = round(max(0.0, (job['cost'] or 0) - (time.time() - job['started_at'])), 1)
+    return payload
+
 # NEW API endpoint for status checking via AJAX
 @app.route('/api/status/<job_id>')
 def api_status(job_id):
-    if job_id not in processing_jobs:
-        return jsonify({'status': 'not_found', 'message': 'Job not found'})
+    """
+    Status of a job
     
-    job = processing_jobs[job_id]
-    return jsonify({
-        'status': job['status'],
-        'message': job.get('error', '') if job['status'] == 'failed' else '',
-        'process_time': job.get('process_time', '')
+    With ?wait=N the request is held (long poll) until the job's status
+    differs from ?status= (default: its current status) or N seconds pass.
+    """
+    wait = request.args.get('wait', 0, type=float)
+    if not math.isfinite(wait):
+        return jsonify({'error': 'wait must be a number of seconds'}), 400
+    wait = min(max(wait, 0), app.config['STATUS_MAX_WAIT'])
+    if wait <= 0:
+        return jsonify(job_status_payload(job_store.get_job(job_id)))
+    
+    known_status = request.args.get('status')
+    if known_status is None:
+        job = job_store.get_job(job_id)
+        if job is None:
+            return jsonify(job_status_payload(None))
+        known_status = job['status']
+    
+    return jsonify(job_status_payload(job_store.wait_for_update(job_id, known_status, wait)))
+
+@app.route('/api/events/<job_id>')
+def job_events(job_id):
+    """
+    Server-Sent Events stream of a job's status changes
+    
+    Sends a 'status' event on every state transition and closes once the job
+    is finished. Streams are capped at STATUS_MAX_WAIT seconds; EventSource
+    reconnects on its own after that.
+    """
+    def generate():
+        deadline = time.time() + app.config['STATUS_MAX_WAIT']
+        job = job_store.get_job(job_id)
+        # Tell the browser how long to wait before reconnecting
+        yield "retry: 1000\n\n"
+        while True:
+            yield f"event: status\ndata: {json.dumps(job_status_payload(job))}\n\n"
+            if job is None or job['status'] in ('completed', 'failed'):
+                return
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            job = job_store.wait_for_update(job_id, job['status'], remaining)
+    
+    # The payloads build URLs, which needs the request context after the view returned
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Stop nginx from buffering the stream
+        'X-Accel-Buffering': 'no'
     })
 
 @app.route('/status/<job_id>')
 def check_status(job_id):
-    if job_id not in processing_jobs:
+    job = job_store.get_job(job_id)
+    if job is None:
         return render_template_string(ERROR_HTML, css=CSS_STYLE, 
                                      error_message="Job not found. It may have expired or been removed.")
     
-    job = processing_jobs[job_id]
     
     # Check the job status
-    if job['status'] == 'pending' or job['status'] == 'processing':
-        # Still processing, show processing page
-        return render_template_string(PROCESSING_HTML, job_id=job_id, css=CSS_STYLE)
+    if job['status'] in ('pending', 'processing', 'preview'):
+        # Still processing, show processing page (with the preview if there is one)
+        preview_url = None
+        if job['status'] == 'preview':
+            preview_url = blob_url('preview_file', job['preview_path'],
+                                   filename=os.path.basename(job['preview_path']))
+        return render_template_string(PROCESSING_HTML, job_id=job_id, preview_url=preview_url, css=CSS_STYLE)
     
     elif job['status'] == 'completed':
         # Processing completed, show result page
         filename = job['filename']
-        return render_template_string(RESULT_HTML, filename=filename, css=CSS_STYLE)
+        result_filename = os.path.basename(job['output_path'])
+        # Jobs served from the result cache have no thumbnails and show the full images
+        thumbnail_urls = {
+            f'{kind}_thumbnail_url': blob_url('thumbnail_file', job[f'{kind}_thumbnail_path'],
+                                              filename=os.path.basename(job[f'{kind}_thumbnail_path']))
+            for kind in ('input', 'output') if job[f'{kind}_thumbnail_path']
+        }
+        return render_template_string(RESULT_HTML, filename=filename,
+                                      input_url=blob_url('uploaded_file', job['input_path'], filename=filename),
+                                      result_url=blob_url('processed_file', job['output_path'],
+                                                          filename=result_filename),
+                                      download_url=blob_url('download_file', job['output_path'],
+                                                            filename=result_filename),
+                                      video=is_video(filename), css=CSS_STYLE, **thumbnail_urls)
     
     else:  # Failed
         # Processing failed, show error page
-        error_message = job.get('error', 'Unknown error occurred during processing')
+        error_message = job['error'] or 'Unknown error occurred during processing'
         return render_template_string(ERROR_HTML, css=CSS_STYLE, error_message=error_message)
 
+def blob_url(endpoint, path, **values):
+    """
+    url_for() of a route serving the blob at path, pinned to its content
+    
+    The digest in ?v= tells clients and proxies that the response may be
+    cached for good (see send_blob()).
+    """
+    info = job_store.get_blob_info(path)
+    if info is not None and info['digest']:
+        values['v'] = info['digest'][:16]
+    return url_for(endpoint, **values)
+
+def send_blob(folder, filename, **kwargs):
+    """
+    Serve an image from the job store, falling back to the folder on disk
+    
+    The blob's digest is its ETag, so revalidation gets a 304, and range
+    requests are answered without sending the whole file. Requested with
+    the ?v= of blob_url() the response is marked immutable; plain URLs are
+    revalidated on every use.
+    """
+    path = os.path.join(folder, filename)
+    info = job_store.get_blob_info(path)
+    if info is None:
+        # Files written before the job store held the images
+        return send_from_directory(folder, filename, **kwargs)
+    
+    version = request.args.get('v')
+    immutable = bool(version and info['digest'] and info['digest'].startswith(version))
+    options = dict(
+        kwargs,
+        mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        download_name=kwargs.get('download_name', filename),
+        # Blobs stored before digests were kept get werkzeug's own ETag
+        etag=info['digest'] or True,
+        last_modified=info['created_at'],
+        max_age=app.config['IMMUTABLE_MAX_AGE'] if immutable else None
+    )
+    
+    if info['file'] is None:
+        data = job_store.get_blob(path)
+        if data is None:
+            return send_from_directory(folder, filename, **kwargs)
+        response = send_file(io.BytesIO(data), **options)
+    elif app.config['SENDFILE_MODE']:
+        # Large blobs live on disk, so the proxy can send them. Only
+        # revalidation is handled here; the proxy answers range requests
+        file_path = os.path.abspath(info['file'])
+        response = werkzeug_send_file(file_path, request.environ, use_x_sendfile=True,
+                                      response_class=app.response_class, conditional=False, **options)
+        response.make_conditional(request.environ)
+        del response.headers['X-Sendfile']
+        if response.status_code != 304:
+            if app.config['SENDFILE_MODE'] == 'x-accel':
+                response.headers['X-Accel-Redirect'] = app.config['X_ACCEL_PREFIX'] + os.path.relpath(file_path)
+            else:
+                response.headers['X-Sendfile'] = file_path
+    else:
+        response = send_file(os.path.abspath(info['file']), **options)
+    
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """Serve original uploaded files"""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_blob(app.config['UPLOAD_FOLDER'], filename)
 
 @app.route('/processed/<filename>')
 def processed_file(filename):
     """Serve processed files"""
-    return send_from_directory(app.config['PROCESSED_FOLDER'], filename)
+    return send_blob(app.config['PROCESSED_FOLDER'], filename)
+
+@app.route('/preview/<filename>')
+def preview_file(filename):
+    """Serve the preview of a job that is still running"""
+    return send_blob(os.path.join(app.config['PROCESSED_FOLDER'], 'previews'), filename)
+
+@app.route('/thumbnail/<filename>')
+def thumbnail_file(filename):
+    """Serve the small versions of a job's images shown on the result page"""
+    return send_blob(os.path.join(app.config['PROCESSED_FOLDER'], 'thumbnails'), filename)
 
 @app.route('/download/<filename>')
 def download_file(filename):
     """Download processed file with proper headers"""
-    return send_from_directory(
+    return send_blob(
         app.config['PROCESSED_FOLDER'], 
         filename, 
         as_attachment=True,
         download_name=f"denoised_{filename}"
     )
 
+@app.route('/api/cache/stats')
+def cache_stats():
+    """Result cache hit/miss counters of this process, for sizing the cache"""
+    return jsonify(result_cache.stats())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Counters, gauges and latency histograms in the Prometheus text format"""
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
 # Clean up old jobs periodically
 def cleanup_old_jobs():
-    """Remove jobs older than 24 hours to prevent memory leaks"""
-    current_time = time.time()
-    jobs_to_remove = []
-    
-    for job_id, job_data in processing_jobs.items():
-        # If job is older than 24 hours (86400 seconds)
-        if current_time - job_data.get('created_at', 0) > 86400:
-            jobs_to_remove.append(job_id)
-    
-    # Remove old jobs
-    for job_id in jobs_to_remove:
-        processing_jobs.pop(job_id, None)
+    """Run one batch of the retention cleanup"""
+    deleted = retention.run_once()
+    for job_id in deleted['expired_jobs']:
         logger.info(f"Cleaned up old job: {job_id}")
+    for job_id in deleted['evicted_jobs']:
+        logger.info(f"Evicted job over the storage quota: {job_id}")
+    if deleted['expired_blobs'] or deleted['evicted_blobs']:
+        logger.info(f"Cleaned up {deleted['expired_blobs']} old and {deleted['evicted_blobs']} "
+                    f"least recently used images")
+    if deleted['stray_files']:
+        logger.info(f"Removed {deleted['stray_files']} stray files")
+    
+    retention_deleted_total.inc(len(deleted['expired_jobs']) + len(deleted['evicted_jobs']), kind='jobs')
+    retention_deleted_total.inc(deleted['expired_blobs'] + deleted['evicted_blobs'], kind='images')
+    retention_deleted_total.inc(deleted['stray_files'], kind='stray_files')
 
 # Start cleanup thread
 def run_cleanup():
@@ -847,21 +2120,26 @@ def run_cleanup():
             cleanup_old_jobs()
         except Exception as e:
             logger.error(f"Error in cleanup thread: {str(e)}")
-        # Sleep for 1 hour before next cleanup
-        time.sleep(3600)
+        # Small batches often rather than everything at once
+        time.sleep(app.config['RETENTION_INTERVAL'])
 
 cleanup_thread = Thread(target=run_cleanup, daemon=True)
-cleanup_thread.start()
+if SERVER_PROCESS:
+    cleanup_thread.start()
 
 # Error handling
 @app.errorhandler(413)
 def request_entity_too_large(error):
     """Handle file too large error"""
+    message = "File is too large. Maximum file size is 16MB."
+    # API clients get JSON, the upload forms are shown again with the error
+    if request.path.startswith('/api/'):
+        return jsonify({'error': message}), 413
     return render_template_string(
         INDEX_HTML, 
         css=CSS_STYLE, 
-        error="File is too large. Maximum file size is 16MB."
-    )
+        error=message
+    ), 413
 
 @app.errorhandler(404)
 def not_found(error):
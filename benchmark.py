@@ -0,0 +1,287 @@
+"""
+Benchmark for the denoising pipeline.
+
+Generates synthetic test images at several resolutions, adds Gaussian noise,
+runs every method across the strength range with and without grayscale and
+reports latency percentiles, throughput (MP/s) and quality (PSNR/SSIM against
+the clean image), so speed/quality trade-offs can be measured and regressions
+spotted.
+
+With --sharpen it instead compares the fused sharpen filter against the
+original filter chain of the sharpen app, in time and in peak memory
+allocated on top of the input image.
+
+Examples:
+    python benchmark.py
+    python benchmark.py --sizes 1920x1080 --methods nlmeans --repeats 5 --json nlmeans.json
+    python benchmark.py --sharpen --sizes 4000x3000
+"""
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from image_processing import process_image, sharpen_filter
+
+
+def make_clean_image(width, height, seed=0):
+    """Deterministic test image with gradients, edges and fine texture"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+
+    # Smooth colour gradients
+    image = np.dstack([
+        128 + 100 * np.sin(x / width * np.pi * 2),
+        128 + 100 * np.cos(y / height * np.pi * 3),
+        128 + 80 * np.sin((x + y) / (width + height) * np.pi * 4),
+    ])
+
+    # Hard edges from random filled shapes
+    scale = min(width, height)
+    for _ in range(12):
+        color = [int(c) for c in rng.integers(0, 256, 3)]
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        if rng.random() < 0.5:
+            cv2.circle(image, center, int(rng.integers(scale // 20, scale // 6)), color, -1)
+        else:
+            size = (int(rng.integers(scale // 20, scale // 5)), int(rng.integers(scale // 20, scale // 5)))
+            cv2.rectangle(image, center, (center[0] + size[0], center[1] + size[1]), color, -1)
+
+    # Fine texture that denoising should preserve
+    image += 12 * np.sin(x / 3.0)[..., None] * np.sin(y / 5.0)[..., None]
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def add_noise(image, sigma, seed=1):
+    """Add Gaussian noise with the given standard deviation"""
+    rng = np.random.default_rng(seed)
+    noisy = image.astype(np.float32) + rng.normal(0, sigma, image.shape).astype(np.float32)
+    return np.clip(noisy, 0, 255).astype(np.uint8)
+
+
+def psnr(reference, image):
+    """Peak signal-to-noise ratio in dB"""
+    return cv2.PSNR(reference, image)
+
+
+def ssim(reference, image):
+    """Mean structural similarity (Wang et al. 2004) on the luma channel"""
+    if reference.ndim == 3:
+        reference = cv2.cvtColor(reference, cv2.COLOR_BGR2GRAY)
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    a = reference.astype(np.float64)
+    b = image.astype(np.float64)
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+
+    def blur(values):
+        return cv2.GaussianBlur(values, (11, 11), 1.5)
+
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a ** 2
+    var_b = blur(b * b) - mu_b ** 2
+    covariance = blur(a * b) - mu_a * mu_b
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * covariance + c2)) / \
+               ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return float(ssim_map.mean())
+
+
+def percentile(values, pct):
+    return float(np.percentile(values, pct))
+
+
+def chained_sharpen(image, intensity=3):
+    """The sharpen app's original filter chain, kept to compare sharpen_filter() against"""
+    gaussian = cv2.GaussianBlur(image, (0, 0), 2)
+    unsharp_mask = cv2.addWeighted(image, 1.5, gaussian, -0.5, 0)
+    laplacian = cv2.Laplacian(image, cv2.CV_8U)
+    sharpened = image.astype(np.float32) + intensity * 0.4 * laplacian.astype(np.float32)
+    sharpened = np.clip(sharpened, 0, 255).astype(np.uint8)
+    if intensity > 3:
+        blend_ratio = (intensity - 3) / 2.0
+        sharpened = cv2.addWeighted(sharpened, 1.0 - blend_ratio, unsharp_mask, blend_ratio, 0)
+    return sharpened
+
+
+def run_sharpen_case(image, implementation, intensity, repeats):
+    """Time one sharpen implementation and measure the memory it allocates"""
+    sharpen = {'fused': sharpen_filter, 'chained': chained_sharpen}[implementation]
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        sharpen(image, intensity)
+        timings.append(time.perf_counter() - start)
+
+    # numpy arrays, including the ones OpenCV returns, are traced
+    tracemalloc.start()
+    sharpen(image, intensity)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    megapixels = image.shape[0] * image.shape[1] / 1e6
+    p50 = percentile(timings, 50)
+    return {
+        'implementation': implementation,
+        'intensity': intensity,
+        'width': image.shape[1],
+        'height': image.shape[0],
+        'repeats': repeats,
+        'p50_ms': p50 * 1000,
+        'p95_ms': percentile(timings, 95) * 1000,
+        'mp_per_s': megapixels / p50 if p50 else 0.0,
+        # Bytes allocated at the peak, as a multiple of the input image
+        'peak_mb': peak / 1e6,
+        'peak_ratio': peak / image.nbytes,
+    }
+
+
+def sharpen_benchmark(sizes, intensities, repeats):
+    """Run and print the sharpen comparison, returning the results"""
+    header = f"{'size':>10} {'impl':>8} {'int':>3} {'p50 ms':>9} {'p95 ms':>9} {'MP/s':>8} " \
+             f"{'peak MB':>8} {'xinput':>6}"
+    print(header)
+    print('-' * len(header))
+
+    results = []
+    for width, height in sizes:
+        image = make_clean_image(width, height)
+        for intensity in intensities:
+            for implementation in ('chained', 'fused'):
+                # Warm up once so one-off allocations don't skew the timings
+                run_sharpen_case(image, implementation, intensity, 1)
+                result = run_sharpen_case(image, implementation, intensity, repeats)
+                results.append(result)
+                print(f"{width}x{height:<5} {implementation:>8} {intensity:>3} {result['p50_ms']:>9.1f} "
+                      f"{result['p95_ms']:>9.1f} {result['mp_per_s']:>8.2f} {result['peak_mb']:>8.1f} "
+                      f"{result['peak_ratio']:>6.1f}")
+    return results
+
+
+def run_case(clean, noisy, method, strength, grayscale, repeats):
+    """Time one parameter combination and measure its output quality"""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        denoised = process_image(noisy, strength=strength, method=method,
+                                 grayscale=grayscale, max_dimension=None)
+        timings.append(time.perf_counter() - start)
+
+    reference = clean
+    if grayscale:
+        # Compare against the clean image put through the same conversion
+        reference = cv2.cvtColor(cv2.cvtColor(clean, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2BGR)
+        if denoised.ndim == 2:
+            reference = cv2.cvtColor(reference, cv2.COLOR_BGR2GRAY)
+
+    megapixels = clean.shape[0] * clean.shape[1] / 1e6
+    p50 = percentile(timings, 50)
+    return {
+        'method': method,
+        'strength': strength,
+        'grayscale': grayscale,
+        'width': clean.shape[1],
+        'height': clean.shape[0],
+        'repeats': repeats,
+        'p50_ms': p50 * 1000,
+        'p95_ms': percentile(timings, 95) * 1000,
+        'max_ms': max(timings) * 1000,
+        'mp_per_s': megapixels / p50 if p50 else 0.0,
+        'psnr': psnr(reference, denoised),
+        'ssim': ssim(reference, denoised),
+    }
+
+
+def parse_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the denoising methods.")
+    parser.add_argument('--sizes', default='640x480,1000x750,1920x1080',
+                        help="comma separated WIDTHxHEIGHT list (default: %(default)s)")
+    parser.add_argument('--methods', default='nlmeans,bilateral,gaussian',
+                        help="comma separated methods (default: %(default)s)")
+    parser.add_argument('--strengths', default='1,5,10',
+                        help="comma separated strengths (default: %(default)s)")
+    parser.add_argument('--grayscale', choices=('both', 'yes', 'no'), default='both',
+                        help="run with grayscale conversion, without, or both (default: both)")
+    parser.add_argument('--sharpen', action='store_true',
+                        help="compare the fused sharpen filter with the original chain instead")
+    parser.add_argument('--intensities', default='1,3,5',
+                        help="comma separated sharpen intensities (default: %(default)s)")
+    parser.add_argument('--noise', type=float, default=20.0, help="noise sigma (default: 20)")
+    parser.add_argument('--repeats', type=int, default=3, help="timed runs per case (default: 3)")
+    parser.add_argument('--threads', type=int, help="cv2.setNumThreads() value (default: OpenCV's)")
+    parser.add_argument('--json', help="also write the results to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.threads is not None:
+        cv2.setNumThreads(args.threads)
+
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    methods = args.methods.split(',')
+    strengths = [int(strength) for strength in args.strengths.split(',')]
+    grayscale_modes = {'both': [False, True], 'yes': [True], 'no': [False]}[args.grayscale]
+
+    if args.sharpen:
+        print(f"OpenCV {cv2.__version__}, {cv2.getNumThreads()} threads, Python {platform.python_version()}")
+        results = sharpen_benchmark(sizes, [int(intensity) for intensity in args.intensities.split(',')],
+                                    args.repeats)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'opencv': cv2.__version__, 'threads': cv2.getNumThreads(), 'results': results},
+                          f, indent=2)
+            print(f"Results written to {args.json}")
+        return 0
+
+    print(f"OpenCV {cv2.__version__}, {cv2.getNumThreads()} threads, Python {platform.python_version()}, "
+          f"noise sigma {args.noise}")
+    header = f"{'size':>10} {'method':>9} {'str':>3} {'gray':>4} {'p50 ms':>9} {'p95 ms':>9} " \
+             f"{'MP/s':>8} {'PSNR':>6} {'SSIM':>6}"
+    print(header)
+    print('-' * len(header))
+
+    results = []
+    for width, height in sizes:
+        clean = make_clean_image(width, height)
+        noisy = add_noise(clean, args.noise)
+        for method in methods:
+            for strength in strengths:
+                for grayscale in grayscale_modes:
+                    # Warm up once so one-off allocations don't skew the timings
+                    process_image(noisy, strength=strength, method=method,
+                                  grayscale=grayscale, max_dimension=None)
+                    result = run_case(clean, noisy, method, strength, grayscale, args.repeats)
+                    results.append(result)
+                    print(f"{width}x{height:<5} {method:>9} {strength:>3} {'yes' if grayscale else 'no':>4} "
+                          f"{result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} {result['mp_per_s']:>8.2f} "
+                          f"{result['psnr']:>6.2f} {result['ssim']:>6.3f}")
+
+        # Quality of doing nothing, as a baseline for the PSNR/SSIM columns
+        print(f"{width}x{height:<5} {'(noisy)':>9} {'':>3} {'':>4} {'':>9} {'':>9} {'':>8} "
+              f"{psnr(clean, noisy):>6.2f} {ssim(clean, noisy):>6.3f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'opencv': cv2.__version__,
+                'threads': cv2.getNumThreads(),
+                'noise_sigma': args.noise,
+                'results': results,
+            }, f, indent=2)
+        print(f"Results written to {args.json}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
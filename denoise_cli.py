@@ -0,0 +1,206 @@
+"""
+Command-line batch denoiser.
+
+Runs the same denoise_image() pipeline as the web app over a directory (or a
+list of files read from stdin) on a pool of worker processes, without going
+through HTTP. Videos and GIFs go through denoise_video().
+
+Examples:
+    python denoise_cli.py photos/ denoised/ --method nlmeans --strength 6
+    find archive -name '*.jpg' | python denoise_cli.py - denoised/ --full-resolution
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from image_processing import denoise_image, is_animated_gif, MAX_DIMENSION, METHODS, OUTPUT_FORMATS
+from video_processing import denoise_video, is_video, video_output_ext, VIDEO_EXTENSIONS
+from worker_pool import init_worker, default_pool_size
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff') + VIDEO_EXTENSIONS
+
+
+def output_format(value):
+    """Extension for --format, given with or without the dot, like the web form's"""
+    ext = '.' + value.lower().lstrip('.')
+    return '.jpg' if ext == '.jpeg' else ext
+
+
+def init_cli_worker(cv_threads, tile_workers, log_level):
+    """Worker initializer that also quiets the per-image log lines"""
+    init_worker(cv_threads, tile_workers)
+    logging.getLogger().setLevel(log_level)
+
+
+def is_video_input(path):
+    """True if a file is denoised as a video: GIFs only when they are animated"""
+    if not path.lower().endswith('.gif'):
+        return is_video(path)
+    try:
+        with open(path, 'rb') as f:
+            return is_animated_gif(f.read())
+    except OSError:
+        # Left for the video path to report
+        return True
+
+
+def process_file(input_path, output_path, options):
+    """
+    Denoise one file inside a worker process
+
+    Returns (input_path, success, message, megapixels, seconds)
+    """
+    start_time = time.time()
+    stats = {}
+    if is_video_input(input_path):
+        if options['method'] == 'auto':
+            return input_path, False, "The auto method is for images only", 0.0, time.time() - start_time
+        # Videos are written with their codec's own settings, and only denoised
+        options = {name: value for name, value in options.items() if name not in ('quality', 'sharpen')}
+        success, message = denoise_video(input_path, output_path, stats=stats, **options)
+    else:
+        success, message = denoise_image(input_path, output_path, stats=stats, **options)
+    megapixels = stats.get('output_pixels', 0) / 1e6
+    return input_path, success, message, megapixels, time.time() - start_time
+
+
+def find_inputs(source, recursive):
+    """
+    Yield (input_path, relative_output_path) pairs
+
+    source is a directory, or '-' to read one path per line from stdin.
+    Paths read from stdin keep their directories below the deepest one they
+    all share, so archive/2020/a.jpg and archive/2021/a.jpg don't collide.
+    """
+    if source == '-':
+        paths = [line.strip() for line in sys.stdin if line.strip()]
+        if paths:
+            base = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+            for path in paths:
+                yield path, os.path.relpath(os.path.abspath(path), base)
+        return
+
+    for root, dirs, files in os.walk(source):
+        if not recursive:
+            dirs[:] = []
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(root, name)
+                yield path, os.path.relpath(path, source)
+
+
+def is_up_to_date(input_path, output_path):
+    """True if the output exists and is newer than the input"""
+    try:
+        return os.path.getmtime(output_path) >= os.path.getmtime(input_path)
+    except OSError:
+        return False
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Denoise many images with the web app's pipeline.")
+    parser.add_argument('input', help="input directory, or - to read file paths from stdin")
+    parser.add_argument('output', help="output directory")
+    parser.add_argument('--method', choices=METHODS, default='nlmeans',
+                        help="auto picks one per image from its measured noise (default: nlmeans)")
+    parser.add_argument('--strength', type=int, choices=range(1, 11), default=5, metavar='1-10')
+    parser.add_argument('--grayscale', action='store_true', help="convert to grayscale")
+    parser.add_argument('--sharpen', type=int, choices=range(0, 6), default=0, metavar='0-5',
+                        help="sharpen images after denoising (default: 0, off)")
+    parser.add_argument('--full-resolution', action='store_true',
+                        help=f"don't downscale images larger than {MAX_DIMENSION}px")
+    parser.add_argument('--format', type=output_format, choices=OUTPUT_FORMATS,
+                        help="output format such as png or webp (default: same as input)")
+    parser.add_argument('--quality', type=int, choices=range(1, 101), metavar='1-100',
+                        help="quality of JPEG, WebP and AVIF outputs (default: 95, 90 and 80)")
+    parser.add_argument('--recursive', '-r', action='store_true', help="descend into subdirectories")
+    parser.add_argument('--force', action='store_true', help="reprocess files whose output is up to date")
+    parser.add_argument('--workers', type=int, default=default_pool_size(),
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument('--cv-threads', type=int, default=1, help="OpenCV threads per worker (default: 1)")
+    parser.add_argument('--tile-workers', type=int, default=1,
+                        help="threads per image for full resolution tiles (default: 1)")
+    parser.add_argument('--verbose', '-v', action='store_true', help="log every processing step")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    log_level = logging.INFO if args.verbose else logging.WARNING
+    logging.basicConfig(level=log_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.input != '-' and not os.path.isdir(args.input):
+        print(f"Input directory not found: {args.input}", file=sys.stderr)
+        return 2
+
+    options = {
+        'strength': args.strength,
+        'method': args.method,
+        'grayscale': args.grayscale,
+        'max_dimension': None if args.full_resolution else MAX_DIMENSION,
+        'tile_workers': args.tile_workers,
+        'quality': args.quality,
+        'sharpen': args.sharpen,
+    }
+
+    # Work out what needs doing before starting the pool
+    jobs = []
+    skipped = 0
+    outputs = {}
+    for input_path, relative_path in find_inputs(args.input, args.recursive):
+        if is_video_input(input_path):
+            # Videos keep their container where OpenCV can write it
+            relative_path = os.path.splitext(relative_path)[0] + \
+                video_output_ext(os.path.splitext(relative_path)[1])
+        elif args.format:
+            relative_path = os.path.splitext(relative_path)[0] + args.format
+        elif relative_path.lower().endswith('.gif'):
+            # Still GIFs come out as PNG, like in the web app
+            relative_path = os.path.splitext(relative_path)[0] + '.png'
+        output_path = os.path.join(args.output, relative_path)
+        # e.g. photo.png and photo.jpg with --format, or a path listed twice
+        if output_path in outputs:
+            print(f"{input_path} and {outputs[output_path]} would both be written to {output_path}",
+                  file=sys.stderr)
+            return 2
+        outputs[output_path] = input_path
+        if not args.force and is_up_to_date(input_path, output_path):
+            skipped += 1
+            continue
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        jobs.append((input_path, output_path))
+
+    print(f"{len(jobs)} images to process, {skipped} already up to date")
+    if not jobs:
+        return 0
+
+    failed = 0
+    total_megapixels = 0.0
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_cli_worker,
+                             initargs=(args.cv_threads, args.tile_workers, log_level)) as executor:
+        futures = [executor.submit(process_file, input_path, output_path, options)
+                   for input_path, output_path in jobs]
+        for done, future in enumerate(as_completed(futures), start=1):
+            input_path, success, message, megapixels, seconds = future.result()
+            if success:
+                total_megapixels += megapixels
+                print(f"[{done}/{len(jobs)}] {input_path} ({seconds:.2f}s)")
+            else:
+                failed += 1
+                print(f"[{done}/{len(jobs)}] {input_path} FAILED: {message}", file=sys.stderr)
+
+    elapsed = time.time() - start_time
+    processed = len(jobs) - failed
+    print(f"Processed {processed} images ({failed} failed, {skipped} skipped) in {elapsed:.2f}s: "
+          f"{processed / elapsed:.2f} images/s, {total_megapixels / elapsed:.2f} MP/s")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,654 @@
+"""
+Job store and queue backends for the denoiser.
+
+The job store holds the status of every job and doubles as the work queue, so
+any gunicorn worker (or a restarted one) can enqueue, claim and report on jobs.
+It also holds the encoded input and output images ("blobs"), so small and
+medium images never go through the filesystem.
+SQLite in WAL mode is the default local backend; other backends implement the
+JobStore interface and register themselves in JOB_STORE_BACKENDS.
+"""
+import os
+import json
+import math
+import hashlib
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class JobStore:
+    """
+    Interface every job store backend implements
+
+    Jobs are plain dicts with at least these keys: job_id, status ('held',
+    'pending', 'processing', 'preview', 'completed' or 'failed'), filename,
+    input_path, output_path, params (dict), error, process_time and
+    created_at. input_path and output_path name the blobs holding the job's
+    images. 'preview' means the job is still processing but a preview is in
+    the blob at preview_path. 'held' jobs are stored but not queued yet, like
+    the jobs of a batch upload until the whole batch has been admitted.
+    """
+
+    def create_job(self, job_id, filename, input_path, output_path, params, **fields):
+        """
+        Add a new job to the queue
+
+        Extra fields are stored with the job; pass status='completed' to record
+        a job that needs no processing.
+        """
+        raise NotImplementedError
+
+    def get_job(self, job_id):
+        """Return the job dict, or None if the job doesn't exist"""
+        raise NotImplementedError
+
+    def update_job(self, job_id, if_status=None, **fields):
+        """
+        Update the given fields of a job
+
+        With if_status the job is only updated while it has that status.
+        Returns whether the job was updated.
+        """
+        raise NotImplementedError
+
+    def list_jobs(self, group_id):
+        """Return the jobs of a batch group, oldest first"""
+        raise NotImplementedError
+
+    def count_jobs(self):
+        """Return a dict mapping each job status to the number of jobs in it"""
+        raise NotImplementedError
+
+    def oldest_pending_age(self):
+        """Return how many seconds the oldest pending job has been waiting, or 0"""
+        raise NotImplementedError
+
+    def queue_load(self, client=None):
+        """
+        Return the work waiting in the queue
+
+        The dict holds the number of pending and processing 'jobs' and their
+        remaining estimated 'cost' in seconds, plus 'client_jobs' and
+        'client_cost' for the jobs submitted by the given client.
+        """
+        raise NotImplementedError
+
+    def queue_position(self, job_id):
+        """
+        Return (jobs_ahead, cost_ahead) for a pending job
+
+        jobs_ahead counts the pending jobs that will be claimed before it and
+        cost_ahead is the estimated seconds of work left in those and in the
+        jobs being processed. Returns None if the job isn't pending.
+        """
+        raise NotImplementedError
+
+    def claim_next_job(self, worker_name):
+        """
+        Atomically take the next pending job off the queue
+
+        The job is marked as 'processing' and returned, or None is returned if
+        there is nothing to do. Jobs left in 'processing' by a worker that died
+        are handed out again once their lease has expired.
+
+        Jobs are scheduled shortest estimated job first: the job with the
+        lowest cost + priority - aging_rate * seconds_waited runs next, so
+        cheap jobs overtake expensive ones but waiting jobs keep gaining
+        ground and are never starved.
+        """
+        raise NotImplementedError
+
+    def delete_jobs_older_than(self, max_age, limit=None):
+        """
+        Delete jobs created more than max_age seconds ago, returning their ids
+
+        With limit set, at most that many of the oldest are deleted per call.
+        """
+        raise NotImplementedError
+
+    def delete_jobs(self, job_ids):
+        """Delete the given jobs together with their blobs"""
+        raise NotImplementedError
+
+    def wait_for_update(self, job_id, status, timeout, poll_interval=0.5):
+        """
+        Wait until the job's status is no longer status, for up to timeout seconds
+
+        Returns the job as it is when the wait ends, or None if it doesn't
+        exist. A timeout that isn't a finite number doesn't wait at all.
+        Backends that can be notified of changes should override this generic
+        polling version.
+        """
+        if not math.isfinite(timeout):
+            timeout = 0
+        deadline = time.time() + timeout
+        while True:
+            job = self.get_job(job_id)
+            if job is None or job['status'] != status or time.time() >= deadline:
+                return job
+            time.sleep(min(poll_interval, max(0, deadline - time.time())))
+
+    def put_blob(self, path, data):
+        """
+        Store an encoded image under path
+
+        Blobs larger than the store's spill threshold are written to a file on
+        disk next to path; smaller ones are kept by the store itself.
+        """
+        raise NotImplementedError
+
+    def get_blob(self, path):
+        """
+        Return the bytes stored under path, or None if there is no such blob
+
+        Reading a blob counts as an access for evict_blobs().
+        """
+        raise NotImplementedError
+
+    def get_blob_file(self, path):
+        """Return the file path of a blob that was spilled to disk, else None"""
+        raise NotImplementedError
+
+    def get_blob_info(self, path):
+        """
+        Return the size, SHA-256 digest, creation time and spilled file (or
+        None) of a blob as a dict, without reading its data
+
+        Returns None if there is no such blob.
+        """
+        raise NotImplementedError
+
+    def delete_blobs_older_than(self, max_age, limit=None):
+        """
+        Delete blobs stored more than max_age seconds ago, returning how many
+
+        With limit set, at most that many of the oldest are deleted per call.
+        """
+        raise NotImplementedError
+
+    def blob_bytes(self):
+        """Total size of all blobs"""
+        raise NotImplementedError
+
+    def evict_blobs(self, max_bytes, limit=100):
+        """
+        Delete the least recently accessed blobs until they take max_bytes
+
+        At most limit blobs are deleted per call. Inputs of jobs that are
+        still waiting or running are kept, and finished jobs that lose their
+        input or output are deleted with them. Returns the number of blobs
+        and the ids of the jobs deleted.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release any resources held by the store"""
+
+
+class SQLiteJobStore(JobStore):
+    """
+    Job store backed by a SQLite database in WAL mode
+
+    Safe to share between threads and between processes on the same machine.
+
+    Parameters:
+    - path: Path to the database file
+    - lease_seconds: How long a job may stay in 'processing' before another
+      worker assumes its owner died and runs it again
+    - spill_bytes: Blobs larger than this are written to disk instead of
+      being stored in the database
+    - wait_poll_interval: How often wait_for_update() re-reads the database to
+      catch changes made by other processes; changes made by this process
+      wake it immediately
+    - aging_rate: Seconds taken off a job's scheduling cost for every second
+      it waits (see claim_next_job())
+    """
+
+    # Column name -> SQL type. Columns missing from an existing database are
+    # added on startup so the schema can grow without a migration tool.
+    COLUMNS = {
+        'job_id': 'TEXT PRIMARY KEY',
+        'status': 'TEXT NOT NULL',
+        'filename': 'TEXT NOT NULL',
+        'input_path': 'TEXT',
+        'output_path': 'TEXT',
+        'params': 'TEXT',
+        'error': 'TEXT',
+        'process_time': 'TEXT',
+        'created_at': 'REAL NOT NULL',
+        'started_at': 'REAL',
+        'finished_at': 'REAL',
+        'claimed_by': 'TEXT',
+        'cache_key': 'TEXT',
+        'group_id': 'TEXT',
+        'cost': 'REAL',
+        'memory': 'INTEGER',
+        'client': 'TEXT',
+        'priority': 'REAL',
+        'priority_class': 'TEXT',
+        'preview_path': 'TEXT',
+        'input_thumbnail_path': 'TEXT',
+        'output_thumbnail_path': 'TEXT',
+    }
+
+    # Same for the blobs table. data is NULL for blobs that were spilled to
+    # disk, into file (or path itself for blobs spilled before file existed)
+    BLOB_COLUMNS = {
+        'path': 'TEXT PRIMARY KEY',
+        'data': 'BLOB',
+        'size': 'INTEGER NOT NULL',
+        'created_at': 'REAL NOT NULL',
+        'digest': 'TEXT',
+        'file': 'TEXT',
+        'accessed_at': 'REAL',
+    }
+
+    # accessed_at is only rewritten once it is this many seconds old, so
+    # serving a popular image doesn't turn every read into a write
+    ACCESS_RESOLUTION = 60
+
+    # Scheduling order of pending jobs. All waiting jobs age at the same rate,
+    # so cost + priority - aging_rate * (now - created_at) orders them the
+    # same way as this expression, which doesn't depend on the time
+    SCHEDULE_KEY = "(COALESCE(cost, 0) + COALESCE(priority, 0) + :aging_rate * created_at)"
+
+    # Estimated seconds of work left in a pending or running job
+    REMAINING_COST = ("CASE WHEN status IN ('processing', 'preview') "
+                      "THEN MAX(0, COALESCE(cost, 0) - (:now - started_at)) "
+                      "ELSE COALESCE(cost, 0) END")
+
+    def __init__(self, path, lease_seconds=3600, spill_bytes=8 * 1024 * 1024,
+                 wait_poll_interval=0.25, aging_rate=0.1):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.spill_bytes = spill_bytes
+        self.wait_poll_interval = wait_poll_interval
+        self.aging_rate = aging_rate
+        self._local = threading.local()
+        # Notified whenever this process changes a job
+        self._changed = threading.Condition()
+        self._create_schema()
+
+    def _connect(self):
+        # One connection per thread and per process; a connection must never
+        # be used again in a forked child
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _create_schema(self):
+        conn = self._connect()
+        for table, table_columns in (('jobs', self.COLUMNS), ('blobs', self.BLOB_COLUMNS)):
+            columns = ', '.join(f"{name} {sql_type}" for name, sql_type in table_columns.items())
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+            existing = {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+            for name, sql_type in table_columns.items():
+                if name not in existing:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {sql_type}")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_group ON jobs (group_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS blobs_created ON blobs (created_at)")
+        # Blobs stored before accesses were tracked count as accessed when stored
+        conn.execute("UPDATE blobs SET accessed_at = created_at WHERE accessed_at IS NULL")
+        conn.execute("CREATE INDEX IF NOT EXISTS blobs_accessed ON blobs (accessed_at)")
+
+    def _notify(self):
+        with self._changed:
+            self._changed.notify_all()
+
+    def _row_to_job(self, row):
+        if row is None:
+            return None
+        job = dict(row)
+        job['params'] = json.loads(job['params']) if job['params'] else {}
+        return job
+
+    def create_job(self, job_id, filename, input_path, output_path, params, **fields):
+        fields.setdefault('status', 'pending')
+        fields.setdefault('created_at', time.time())
+        fields.update(job_id=job_id, filename=filename, input_path=input_path,
+                      output_path=output_path, params=json.dumps(params))
+        for name in fields:
+            if name not in self.COLUMNS:
+                raise ValueError(f"Unknown job field: {name}")
+        self._connect().execute(
+            f"INSERT INTO jobs ({', '.join(fields)}) VALUES ({', '.join('?' for _ in fields)})",
+            list(fields.values())
+        )
+        self._notify()
+
+    def get_job(self, job_id):
+        row = self._connect().execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row)
+
+    def update_job(self, job_id, if_status=None, **fields):
+        if not fields:
+            return False
+        for name in fields:
+            if name not in self.COLUMNS:
+                raise ValueError(f"Unknown job field: {name}")
+        if 'params' in fields:
+            fields['params'] = json.dumps(fields['params'])
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        values = list(fields.values()) + [job_id]
+        condition = "job_id = ?"
+        if if_status is not None:
+            condition += " AND status = ?"
+            values.append(if_status)
+        updated = self._connect().execute(
+            f"UPDATE jobs SET {assignments} WHERE {condition}", values
+        ).rowcount > 0
+        self._notify()
+        return updated
+
+    def list_jobs(self, group_id):
+        rows = self._connect().execute(
+            "SELECT * FROM jobs WHERE group_id = ? ORDER BY created_at, job_id", (group_id,)
+        )
+        return [self._row_to_job(row) for row in rows]
+
+    def count_jobs(self):
+        rows = self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return {status: count for status, count in rows}
+
+    def oldest_pending_age(self):
+        row = self._connect().execute("SELECT MIN(created_at) FROM jobs WHERE status = 'pending'").fetchone()
+        return time.time() - row[0] if row[0] is not None else 0.0
+
+    def queue_load(self, client=None):
+        row = self._connect().execute(
+            "SELECT COUNT(*) AS jobs, COALESCE(SUM(remaining), 0) AS cost, "
+            "COALESCE(SUM(client = :client), 0) AS client_jobs, "
+            "COALESCE(SUM(CASE WHEN client = :client THEN remaining ELSE 0 END), 0) AS client_cost "
+            f"FROM (SELECT client, {self.REMAINING_COST} AS remaining FROM jobs "
+            "WHERE status IN ('pending', 'processing', 'preview'))",
+            {'now': time.time(), 'client': client}
+        ).fetchone()
+        return dict(row)
+
+    def queue_position(self, job_id):
+        job = self.get_job(job_id)
+        if job is None or job['status'] != 'pending':
+            return None
+        key = ((job['cost'] or 0) + (job['priority'] or 0) + self.aging_rate * job['created_at'],
+               job['created_at'], job_id)
+        row = self._connect().execute(
+            "SELECT COALESCE(SUM(status = 'pending'), 0) AS jobs, "
+            f"COALESCE(SUM({self.REMAINING_COST}), 0) AS cost FROM jobs "
+            "WHERE status IN ('processing', 'preview') OR (status = 'pending' AND "
+            f"({self.SCHEDULE_KEY}, created_at, job_id) < (:key, :created_at, :job_id))",
+            {'now': time.time(), 'aging_rate': self.aging_rate,
+             'key': key[0], 'created_at': key[1], 'job_id': key[2]}
+        ).fetchone()
+        return row['jobs'], row['cost']
+
+    def claim_next_job(self, worker_name):
+        conn = self._connect()
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can
+        # never claim the same job
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Jobs whose lease expired go first, they have waited longest
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status IN ('processing', 'preview') AND started_at < :lease_cutoff "
+                "ORDER BY started_at LIMIT 1",
+                {'lease_cutoff': now - self.lease_seconds}
+            ).fetchone()
+            if row is None:
+                row = conn.execute(
+                    f"SELECT * FROM jobs WHERE status = 'pending' "
+                    f"ORDER BY {self.SCHEDULE_KEY}, created_at, job_id LIMIT 1",
+                    {'aging_rate': self.aging_rate}
+                ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            if row['status'] != 'pending':
+                logger.warning(f"Lease expired for job {row['job_id']}, running it again")
+            conn.execute(
+                "UPDATE jobs SET status = 'processing', started_at = ?, claimed_by = ? WHERE job_id = ?",
+                (now, worker_name, row['job_id'])
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._notify()
+        job = self._row_to_job(row)
+        job.update(status='processing', started_at=now, claimed_by=worker_name)
+        return job
+
+    def delete_jobs_older_than(self, max_age, limit=None):
+        conn = self._connect()
+        params = {'cutoff': time.time() - max_age, 'limit': -1 if limit is None else limit}
+        oldest = "SELECT job_id FROM jobs WHERE created_at < :cutoff ORDER BY created_at LIMIT :limit"
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            job_ids = [row['job_id'] for row in conn.execute(oldest, params)]
+            conn.execute(f"DELETE FROM jobs WHERE job_id IN ({oldest})", params)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return job_ids
+
+    def delete_jobs(self, job_ids):
+        conn = self._connect()
+        placeholders = ', '.join('?' for _ in job_ids)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            paths = [path for row in conn.execute(
+                "SELECT input_path, output_path, preview_path, input_thumbnail_path, output_thumbnail_path "
+                f"FROM jobs WHERE job_id IN ({placeholders})", job_ids)
+                for path in row if path]
+            conn.execute(f"DELETE FROM jobs WHERE job_id IN ({placeholders})", job_ids)
+            files = self._delete_blobs(conn, paths)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._notify()
+        self._remove_files(files)
+
+    def wait_for_update(self, job_id, status, timeout, poll_interval=None):
+        poll_interval = poll_interval or self.wait_poll_interval
+        # A NaN or infinite timeout would never run out
+        if not math.isfinite(timeout):
+            timeout = 0
+        deadline = time.time() + timeout
+        while True:
+            job = self.get_job(job_id)
+            remaining = deadline - time.time()
+            if job is None or job['status'] != status or remaining <= 0:
+                return job
+            # Woken right away by changes from this process; changes from
+            # other processes are seen on the next poll
+            with self._changed:
+                self._changed.wait(min(remaining, poll_interval))
+
+    @staticmethod
+    def _spill_file(path):
+        """File a blob stored under path is spilled to"""
+        # Shard by a hash of the name so no single directory gets huge
+        directory, name = os.path.split(path)
+        return os.path.join(directory, hashlib.sha256(name.encode('utf-8')).hexdigest()[:2], name)
+
+    def put_blob(self, path, data):
+        data = bytes(data)
+        now = time.time()
+        if len(data) > self.spill_bytes:
+            file = self._spill_file(path)
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            with open(file, 'wb') as f:
+                f.write(data)
+            stored = None
+        else:
+            file = None
+            stored = sqlite3.Binary(data)
+        self._connect().execute(
+            "INSERT OR REPLACE INTO blobs (path, data, size, created_at, digest, file, accessed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (path, stored, len(data), now, hashlib.sha256(data).hexdigest(), file, now)
+        )
+
+    def _touch(self, conn, row, path):
+        """Record an access to a blob read as row"""
+        now = time.time()
+        if row['accessed_at'] is None or now - row['accessed_at'] > self.ACCESS_RESOLUTION:
+            conn.execute("UPDATE blobs SET accessed_at = ? WHERE path = ?", (now, path))
+
+    def get_blob(self, path):
+        conn = self._connect()
+        row = conn.execute("SELECT data, COALESCE(file, path) AS file, accessed_at FROM blobs WHERE path = ?",
+                           (path,)).fetchone()
+        if row is None:
+            return None
+        self._touch(conn, row, path)
+        if row['data'] is None:
+            try:
+                with open(row['file'], 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+        return bytes(row['data'])
+
+    def get_blob_file(self, path):
+        row = self._connect().execute(
+            "SELECT COALESCE(file, path) AS file FROM blobs WHERE path = ? AND data IS NULL", (path,)
+        ).fetchone()
+        return row['file'] if row is not None else None
+
+    def get_blob_info(self, path):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT size, digest, created_at, accessed_at, data IS NULL AS spilled, "
+            "COALESCE(file, path) AS file FROM blobs WHERE path = ?", (path,)
+        ).fetchone()
+        if row is None:
+            return None
+        self._touch(conn, row, path)
+        return {
+            'size': row['size'],
+            'digest': row['digest'],
+            'created_at': row['created_at'],
+            'file': row['file'] if row['spilled'] else None,
+        }
+
+    def _delete_blobs(self, conn, paths):
+        """Delete blobs inside the caller's transaction, returning the files to remove after it"""
+        if not paths:
+            return []
+        placeholders = ', '.join('?' for _ in paths)
+        files = [row['file'] for row in conn.execute(
+            f"SELECT COALESCE(file, path) AS file FROM blobs WHERE path IN ({placeholders}) AND data IS NULL",
+            paths)]
+        conn.execute(f"DELETE FROM blobs WHERE path IN ({placeholders})", paths)
+        return files
+
+    @staticmethod
+    def _remove_files(files):
+        for file in files:
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+
+    def delete_blobs_older_than(self, max_age, limit=None):
+        conn = self._connect()
+        params = {'cutoff': time.time() - max_age, 'limit': -1 if limit is None else limit}
+        oldest = "SELECT path FROM blobs WHERE created_at < :cutoff ORDER BY created_at LIMIT :limit"
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            files = [row['file'] for row in conn.execute(
+                f"SELECT COALESCE(file, path) AS file FROM blobs WHERE path IN ({oldest}) AND data IS NULL",
+                params)]
+            count = conn.execute(f"DELETE FROM blobs WHERE path IN ({oldest})", params).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._remove_files(files)
+        return count
+
+    def blob_bytes(self):
+        return self._connect().execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def evict_blobs(self, max_bytes, limit=100):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            evicted = []
+            if total > max_bytes:
+                candidates = conn.execute(
+                    "SELECT path, size FROM blobs WHERE path NOT IN ("
+                    "SELECT input_path FROM jobs WHERE status IN ('held', 'pending', 'processing', 'preview') "
+                    "AND input_path IS NOT NULL) ORDER BY accessed_at LIMIT ?", (limit,)
+                ).fetchall()
+                for row in candidates:
+                    if total <= max_bytes:
+                        break
+                    evicted.append(row['path'])
+                    total -= row['size']
+
+            job_ids = []
+            if evicted:
+                placeholders = ', '.join('?' for _ in evicted)
+                job_ids = [row['job_id'] for row in conn.execute(
+                    f"SELECT job_id FROM jobs WHERE status IN ('completed', 'failed') "
+                    f"AND (input_path IN ({placeholders}) OR output_path IN ({placeholders}))",
+                    evicted + evicted)]
+                conn.execute(f"DELETE FROM jobs WHERE job_id IN ({', '.join('?' for _ in job_ids)})", job_ids)
+            files = self._delete_blobs(conn, evicted)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if job_ids:
+            self._notify()
+        self._remove_files(files)
+        return len(evicted), job_ids
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local = threading.local()
+
+
+def _sqlite_from_url(location, **options):
+    # Same convention as SQLAlchemy: sqlite:///relative.db, sqlite:////absolute.db
+    return SQLiteJobStore(location[1:] if location.startswith('/') else location, **options)
+
+
+# Backend name -> factory taking the part of the URL after "name://" and the
+# keyword options passed to create_job_store()
+JOB_STORE_BACKENDS = {
+    'sqlite': _sqlite_from_url,
+}
+
+
+def create_job_store(url, **options):
+    """
+    Create a job store from a URL such as "sqlite:///jobs.db"
+
+    A plain file path is treated as a SQLite database. Keyword options are
+    passed on to the backend.
+    """
+    if '://' not in url:
+        return SQLiteJobStore(url, **options)
+    backend, location = url.split('://', 1)
+    if backend not in JOB_STORE_BACKENDS:
+        raise ValueError(f"Unknown job store backend: {backend}")
+    return JOB_STORE_BACKENDS[backend](location, **options)
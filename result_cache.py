@@ -0,0 +1,141 @@
+"""
+Content-addressed cache of processed images.
+
+Results are stored on disk under a key derived from the hash of the uploaded
+bytes and every parameter that affects the output, so re-uploading the same
+photo with the same settings is answered without running the filters again.
+The cache has a byte budget and evicts the least recently used entries.
+"""
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def content_digest(data):
+    """Return the SHA-256 hex digest of some bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk LRU cache of processed images
+
+    Entries are plain files whose modification time is bumped on every hit,
+    so the file mtime is the LRU order and the cache can be shared by several
+    processes.
+
+    Parameters:
+    - directory: Folder holding the cached results
+    - max_bytes: Total size budget; 0 disables the cache
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._total_bytes = sum(size for _, _, size in self._entries())
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def make_key(content_hash, **params):
+        """Build the cache key for an input hash and the processing parameters"""
+        description = json.dumps(dict(params, content=content_hash), sort_keys=True)
+        return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        # Shard by key prefix so no single directory gets huge
+        return os.path.join(self.directory, key[:2], key)
+
+    def _entries(self):
+        """Yield (path, mtime, size) for every file in the cache"""
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                # Skip entries that are still being written
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def get(self, key):
+        """Return the cached result for key, or None on a miss"""
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Mark the entry as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """Store data under key, evicting old entries if needed"""
+        if not self.enabled:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._total_bytes += len(data)
+            over_budget = self._total_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits its budget"""
+        with self._lock:
+            # Rescan since other processes share the directory
+            entries = sorted(self._entries(), key=lambda entry: entry[1])
+            total = sum(size for _, _, size in entries)
+            for path, _, size in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                    logger.info(f"Evicted cached result: {os.path.basename(path)}")
+                except FileNotFoundError:
+                    total -= size
+            self._total_bytes = total
+
+    def stats(self):
+        """Return hit/miss counters and size information"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+            }
@@ -0,0 +1,104 @@
+"""
+Retention of the stored jobs and images.
+
+Jobs and their uploads, results, previews and thumbnails are kept for a
+limited time and, optionally, within a total size quota; over the quota the
+least recently accessed images go first. Every run does a bounded batch of
+each kind of work, so runs are short and frequent instead of one hourly pass
+over everything. Files on disk that no longer belong to any image (left by
+earlier versions or interrupted writes) are swept a few directories per run.
+"""
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionManager:
+    """
+    Expires old jobs and images and keeps the images within a size quota
+
+    Parameters:
+    - job_store: JobStore holding the jobs and images
+    - folders: Directories images are spilled to, swept for stray files
+    - max_age: Seconds jobs and images are kept
+    - max_bytes: Total size the images may take, or None for no quota
+    - batch_size: Most jobs or images each kind of cleanup deletes per run
+    - sweep_directories: Directories the stray file sweep looks at per run
+    """
+
+    def __init__(self, job_store, folders, max_age=86400, max_bytes=None, batch_size=500,
+                 sweep_directories=16):
+        self.job_store = job_store
+        self.folders = list(folders)
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.sweep_directories = sweep_directories
+        # Directories of the sweep pass in progress
+        self._directories = iter(())
+
+    def run_once(self):
+        """
+        Do one batch of every kind of cleanup
+
+        Returns a dict with the ids of the expired and evicted jobs and the
+        numbers of expired and evicted images and stray files removed.
+        """
+        expired_jobs = self.job_store.delete_jobs_older_than(self.max_age, self.batch_size)
+        expired_blobs = self.job_store.delete_blobs_older_than(self.max_age, self.batch_size)
+        evicted_blobs, evicted_jobs = 0, []
+        if self.max_bytes is not None:
+            evicted_blobs, evicted_jobs = self.job_store.evict_blobs(self.max_bytes, self.batch_size)
+        return {
+            'expired_jobs': expired_jobs,
+            'expired_blobs': expired_blobs,
+            'evicted_jobs': evicted_jobs,
+            'evicted_blobs': evicted_blobs,
+            'stray_files': self.sweep(),
+        }
+
+    def _walk(self):
+        for folder in self.folders:
+            for root, _, _ in os.walk(folder):
+                yield root
+
+    def _next_directories(self):
+        """The next sweep_directories directories, starting a new pass when one ends"""
+        directories = []
+        restarted = False
+        while len(directories) < self.sweep_directories:
+            directory = next(self._directories, None)
+            if directory is None:
+                # At most one new pass per run, so small trees aren't walked repeatedly
+                if restarted:
+                    break
+                self._directories = self._walk()
+                restarted = True
+                continue
+            directories.append(directory)
+        return directories
+
+    def sweep(self):
+        """
+        Remove files older than max_age from the next few directories
+
+        The images themselves expire after max_age too, so any older file is
+        no longer needed. Returns the number of files removed.
+        """
+        cutoff = time.time() - self.max_age
+        removed = 0
+        for directory in self._next_directories():
+            try:
+                entries = list(os.scandir(directory))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """The app module, imported in a scratch directory with a single worker"""
+    directory = tmp_path_factory.mktemp('denoiser')
+    os.chdir(directory)
+    os.environ['JOB_STORE_URL'] = f"sqlite:///{directory / 'jobs.db'}"
+    os.environ['WORKER_POOL_SIZE'] = '1'
+    import app
+    yield app
+    app.shutdown_workers()
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+def encoded_image(width=64, height=48, ext='.png', seed=0):
+    """Encoded random image for uploads"""
+    image = np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    return cv2.imencode(ext, image)[1].tobytes()
+
+
+# A 1x1 GIF, and the same with its frame shown twice
+STILL_GIF = (b'GIF89a\x01\x00\x01\x00\x80\x00\x00\xff\xff\xff\x00\x00\x00'
+             b',\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;')
+_GIF_FRAME = b'!\xf9\x04\x00\x0a\x00\x00\x00' + STILL_GIF[19:-1]
+ANIMATED_GIF = STILL_GIF[:19] + _GIF_FRAME + _GIF_FRAME + b';'
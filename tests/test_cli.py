@@ -0,0 +1,50 @@
+import io
+
+import denoise_cli
+
+from conftest import STILL_GIF, encoded_image
+
+
+def test_format_without_dot(tmp_path):
+    source = tmp_path / 'in'
+    source.mkdir()
+    (source / 'photo.png').write_bytes(encoded_image())
+
+    assert denoise_cli.main([str(source), str(tmp_path / 'out'), '--format', 'WebP', '--workers', '1']) == 0
+    assert [path.name for path in (tmp_path / 'out').iterdir()] == ['photo.webp']
+
+
+def test_jpeg_format_is_written_as_jpg():
+    assert denoise_cli.parse_args(['in', 'out', '--format', 'jpeg']).format == '.jpg'
+
+
+def test_paths_from_stdin_keep_their_directories(tmp_path, monkeypatch):
+    paths = []
+    for year in ('2020', '2021'):
+        (tmp_path / 'archive' / year).mkdir(parents=True)
+        path = tmp_path / 'archive' / year / 'IMG_0001.png'
+        path.write_bytes(encoded_image(seed=int(year)))
+        paths.append(str(path))
+    monkeypatch.setattr('sys.stdin', io.StringIO('\n'.join(paths) + '\n'))
+
+    assert denoise_cli.main(['-', str(tmp_path / 'out'), '--workers', '1']) == 0
+    assert (tmp_path / 'out' / '2020' / 'IMG_0001.png').exists()
+    assert (tmp_path / 'out' / '2021' / 'IMG_0001.png').exists()
+
+
+def test_inputs_with_the_same_output_are_refused(tmp_path):
+    source = tmp_path / 'in'
+    source.mkdir()
+    (source / 'photo.png').write_bytes(encoded_image())
+    (source / 'photo.jpg').write_bytes(encoded_image(ext='.jpg'))
+
+    assert denoise_cli.main([str(source), str(tmp_path / 'out'), '--format', 'webp']) == 2
+
+
+def test_still_gif_is_written_as_png(tmp_path):
+    source = tmp_path / 'in'
+    source.mkdir()
+    (source / 'icon.gif').write_bytes(STILL_GIF)
+
+    assert denoise_cli.main([str(source), str(tmp_path / 'out'), '--workers', '1']) == 0
+    assert [path.name for path in (tmp_path / 'out').iterdir()] == ['icon.png']
@@ -0,0 +1,57 @@
+import json
+
+from conftest import encoded_image
+
+
+def read_events(response):
+    """Parse the payloads of the events of a finished event stream"""
+    events = []
+    for block in response.get_data(as_text=True).split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in block.splitlines() if ': ' in line)
+        if 'data' in lines:
+            events.append((lines.get('event'), json.loads(lines['data'])))
+    return events
+
+
+def test_event_stream_of_completed_job(app_module, client):
+    data = encoded_image()
+    params = app_module.get_processing_params({})
+    filename = app_module.unique_filename('done.png')
+    job_id = app_module.record_cached_job(data, data, filename, params, 'test-key')
+
+    response = client.get(f'/api/events/{job_id}')
+    assert response.status_code == 200
+    events = read_events(response)
+    assert events[-1][0] == 'status'
+    assert events[-1][1]['status'] == 'completed'
+    assert events[-1][1]['result_url'].startswith('/processed/')
+
+
+def test_event_stream_of_job_with_preview(app_module, client, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'STATUS_MAX_WAIT', 0.1)
+    data = encoded_image()
+    params = app_module.get_processing_params({})
+    filename = app_module.unique_filename('slow.png')
+    job_id = f"preview_{filename}"
+    input_path = f"{app_module.app.config['UPLOAD_FOLDER']}/{filename}"
+    output_path = f"{app_module.app.config['PROCESSED_FOLDER']}/{filename}"
+    preview_path = f"{app_module.app.config['PROCESSED_FOLDER']}/previews/{filename}"
+    app_module.job_store.put_blob(preview_path, data)
+    # Created straight in the preview state so the dispatcher leaves it alone
+    app_module.job_store.create_job(job_id, filename, input_path, output_path, params,
+                                    status='preview', preview_path=preview_path, started_at=0)
+
+    response = client.get(f'/api/events/{job_id}')
+    assert response.status_code == 200
+    events = read_events(response)
+    assert events[0][1]['status'] == 'preview'
+    assert events[0][1]['preview_url']
+
+
+def test_long_poll_rejects_endless_wait(app_module, client):
+    data = encoded_image()
+    params = app_module.get_processing_params({})
+    job_id = app_module.record_cached_job(data, data, app_module.unique_filename('nan.png'), params, 'test-key')
+
+    assert client.get(f'/api/status/{job_id}?wait=nan').status_code == 400
+    assert client.get(f'/api/status/{job_id}?wait=-5').get_json()['status'] == 'completed'
@@ -0,0 +1,31 @@
+import pytest
+
+from image_processing import decode_image, estimate_pipeline_cost, is_animated_gif, _filter_cost
+
+from conftest import ANIMATED_GIF, STILL_GIF
+
+
+def test_auto_cost_when_nlmeans_fits_the_budget():
+    stages = [('auto', 2000)]
+    assert estimate_pipeline_cost(1000, 1000, stages) == pytest.approx(_filter_cost(1000, 1000, 'nlmeans', False))
+
+
+def test_auto_cost_is_the_cheap_filter_it_falls_back_to():
+    # nlmeans would take ~10s here, well over the 2s budget
+    stages = [('auto', 2000)]
+    assert estimate_pipeline_cost(3000, 2500, stages) == \
+        pytest.approx(_filter_cost(3000, 2500, 'bilateral', False))
+    assert estimate_pipeline_cost(3000, 2500, [('auto', 0)]) == \
+        pytest.approx(_filter_cost(3000, 2500, 'gaussian', False))
+
+
+def test_is_animated_gif_counts_the_frames():
+    assert not is_animated_gif(STILL_GIF)
+    assert is_animated_gif(ANIMATED_GIF)
+    # Cut inside the second frame
+    assert not is_animated_gif(ANIMATED_GIF[:40])
+    assert not is_animated_gif(b'\x89PNG\r\n\x1a\n')
+
+
+def test_still_gif_decodes_as_an_image():
+    assert decode_image(STILL_GIF).shape == (1, 1, 3)
@@ -0,0 +1,96 @@
+import time
+
+import pytest
+
+from job_store import SQLiteJobStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteJobStore(str(tmp_path / 'jobs.db'))
+
+
+def add_job(store, job_id, **fields):
+    store.create_job(job_id, f'{job_id}.png', f'uploads/{job_id}.png', f'processed/{job_id}.png', {}, **fields)
+
+
+@pytest.mark.parametrize('timeout', [float('nan'), float('inf')])
+def test_wait_for_update_with_endless_timeout_returns(store, timeout):
+    add_job(store, 'a')
+    start = time.time()
+    assert store.wait_for_update('a', 'pending', timeout)['status'] == 'pending'
+    assert time.time() - start < 1
+
+
+def test_claim_takes_each_job_once(store):
+    add_job(store, 'a')
+    add_job(store, 'b')
+
+    first = store.claim_next_job('worker-1')
+    second = store.claim_next_job('worker-2')
+    assert {first['job_id'], second['job_id']} == {'a', 'b'}
+    assert first['status'] == 'processing' and first['claimed_by'] == 'worker-1'
+    assert store.get_job(second['job_id'])['claimed_by'] == 'worker-2'
+    assert store.claim_next_job('worker-1') is None
+
+
+def test_expired_lease_is_claimed_again(tmp_path):
+    store = SQLiteJobStore(str(tmp_path / 'jobs.db'), lease_seconds=60)
+    add_job(store, 'a')
+    store.claim_next_job('worker-1')
+    assert store.claim_next_job('worker-2') is None
+
+    # The first worker died long ago
+    store.update_job('a', started_at=time.time() - 120)
+    job = store.claim_next_job('worker-2')
+    assert job['job_id'] == 'a' and job['claimed_by'] == 'worker-2'
+
+
+def test_held_jobs_are_not_claimed(store):
+    add_job(store, 'a', status='held')
+    assert store.claim_next_job('worker-1') is None
+
+
+def claim_order(store):
+    order = []
+    while (job := store.claim_next_job('worker')) is not None:
+        order.append(job['job_id'])
+    return order
+
+
+def test_shortest_job_runs_first(store):
+    now = time.time()
+    add_job(store, 'long', cost=10, created_at=now)
+    add_job(store, 'short', cost=1, created_at=now)
+    add_job(store, 'medium', cost=5, created_at=now)
+    assert claim_order(store) == ['short', 'medium', 'long']
+
+
+def test_priority_penalty_lets_interactive_jobs_go_first(store):
+    now = time.time()
+    add_job(store, 'batch', cost=1, priority=60, created_at=now)
+    add_job(store, 'interactive', cost=10, priority=0, created_at=now)
+    assert claim_order(store) == ['interactive', 'batch']
+
+
+def test_waiting_jobs_age_past_new_short_ones(store):
+    now = time.time()
+    # Waited 1000s at 0.1s per second, enough to make up for its 100s
+    add_job(store, 'old', cost=100, created_at=now - 1001)
+    add_job(store, 'new', cost=1, created_at=now)
+    assert claim_order(store) == ['old', 'new']
+
+
+def test_queue_position_counts_the_work_ahead(store):
+    now = time.time()
+    add_job(store, 'running', cost=4, created_at=now - 10)
+    store.claim_next_job('worker')
+    add_job(store, 'short', cost=1, created_at=now)
+    add_job(store, 'long', cost=10, created_at=now)
+
+    jobs_ahead, cost_ahead = store.queue_position('long')
+    assert jobs_ahead == 1
+    # The short job plus what is left of the running one
+    assert 4 < cost_ahead <= 5
+    assert store.queue_position('short')[0] == 0
+    assert store.queue_position('running') is None
@@ -0,0 +1,85 @@
+import types
+
+import pytest
+
+import job_store as job_store_module
+from job_store import SQLiteJobStore
+from retention import RetentionManager
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Time seen by the job store, moved on by hand"""
+    clock = types.SimpleNamespace(now=1_000_000.0)
+    monkeypatch.setattr(job_store_module, 'time', types.SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+@pytest.fixture
+def store(tmp_path, clock):
+    return SQLiteJobStore(str(tmp_path / 'jobs.db'), spill_bytes=1000)
+
+
+def add_job(store, job_id, status='completed', size=100):
+    input_path, output_path = f'uploads/{job_id}.png', f'processed/{job_id}.png'
+    store.put_blob(input_path, bytes(size))
+    store.put_blob(output_path, bytes(size))
+    store.create_job(job_id, f'{job_id}.png', input_path, output_path, {}, status=status)
+
+
+def test_old_jobs_expire_whatever_their_status(store, clock):
+    add_job(store, 'done')
+    add_job(store, 'waiting', status='pending')
+    clock.now += 100
+    add_job(store, 'new')
+
+    assert sorted(store.delete_jobs_older_than(50)) == ['done', 'waiting']
+    assert store.get_job('waiting') is None
+    assert store.get_job('new') is not None
+    assert store.delete_blobs_older_than(50) == 4
+    assert store.get_blob('processed/new.png') is not None
+
+
+def test_expiry_is_done_in_batches(store, clock):
+    for index in range(5):
+        add_job(store, f'job{index}')
+        clock.now += 1
+    assert store.delete_jobs_older_than(0, limit=2) == ['job0', 'job1']
+    assert len(store.delete_jobs_older_than(0)) == 3
+
+
+def test_least_recently_used_images_are_evicted_first(store, clock):
+    add_job(store, 'old')
+    clock.now += 100
+    add_job(store, 'new')
+    clock.now += 100
+    # Reading the old job's images makes the new job the least recently used
+    store.get_blob('uploads/old.png')
+    store.get_blob('processed/old.png')
+
+    evicted, job_ids = store.evict_blobs(max_bytes=250)
+    assert evicted == 2
+    assert job_ids == ['new']
+    assert store.get_job('new') is None
+    assert store.get_blob('processed/old.png') is not None
+
+
+def test_inputs_of_waiting_jobs_are_not_evicted(store):
+    add_job(store, 'waiting', status='pending')
+    evicted, job_ids = store.evict_blobs(max_bytes=0)
+    assert evicted == 1 and job_ids == []
+    assert store.get_blob('uploads/waiting.png') is not None
+    assert store.get_job('waiting') is not None
+
+
+def test_spilled_images_are_removed_from_disk(tmp_path, store, clock):
+    folder = tmp_path / 'uploads'
+    path = str(folder / 'big.png')
+    store.put_blob(path, bytes(5000))
+    spilled = store.get_blob_file(path)
+    assert spilled is not None
+    clock.now += 100
+
+    report = RetentionManager(store, [str(folder)], max_age=50).run_once()
+    assert report['expired_blobs'] == 1
+    assert not (tmp_path / spilled).exists()
@@ -0,0 +1,21 @@
+import os
+
+from conftest import encoded_image
+
+
+def test_download_fallback_keeps_attachment_name(app_module, client, monkeypatch, tmp_path):
+    data = encoded_image()
+    filename = app_module.unique_filename('fallback.png')
+    # send_from_directory() resolves relative folders against the app's root
+    folder = str(tmp_path)
+    monkeypatch.setitem(app_module.app.config, 'PROCESSED_FOLDER', folder)
+    app_module.job_store.put_blob(os.path.join(folder, filename), data)
+    with open(os.path.join(folder, filename), 'wb') as f:
+        f.write(data)
+    # The blob vanishes between reading its info and its data
+    monkeypatch.setattr(app_module.job_store, 'get_blob', lambda path: None)
+
+    response = client.get(f'/download/{filename}')
+    assert response.status_code == 200
+    assert response.data == data
+    assert f'filename=denoised_{filename}' in response.headers['Content-Disposition']
@@ -0,0 +1,76 @@
+import hashlib
+import io
+
+import pytest
+
+from image_processing import sniff_format
+from upload_stream import UploadRejected, UploadStream
+
+from conftest import encoded_image
+
+
+@pytest.mark.parametrize('ext', ['.png', '.jpg', '.bmp', '.tiff'])
+def test_sniff_format_knows_the_magic_bytes(ext):
+    assert sniff_format(encoded_image(ext=ext)) == ext
+
+
+def test_sniff_format_refuses_other_bytes():
+    assert sniff_format(b'<html><body>') is None
+
+
+def test_stream_hashes_what_it_keeps():
+    stream = UploadStream()
+    for chunk in (b'abc', b'def', b'ghi'):
+        stream.write(chunk)
+    assert stream.finish() == (b'abcdefghi', hashlib.sha256(b'abcdefghi').hexdigest())
+
+
+def test_check_sees_the_header_until_it_decides():
+    headers = []
+
+    def check(header, complete):
+        headers.append(header)
+        return len(header) >= 4
+
+    stream = UploadStream(check, sniff_bytes=8)
+    for chunk in (b'ab', b'cd', b'ef'):
+        stream.write(chunk)
+    stream.finish()
+    assert headers == [b'ab', b'abcd']
+
+
+def test_check_runs_on_the_whole_upload_when_it_is_short():
+    calls = []
+
+    def check(header, complete):
+        calls.append((header, complete))
+        return False
+
+    stream = UploadStream(check, sniff_bytes=8)
+    stream.write(b'ab')
+    stream.finish()
+    assert calls == [(b'ab', False), (b'ab', True)]
+
+
+def test_rejection_stops_the_upload_at_the_first_chunk():
+    def check(header, complete):
+        if sniff_format(header) is None:
+            raise UploadRejected('not an image')
+        return True
+
+    stream = UploadStream(check)
+    with pytest.raises(UploadRejected) as raised:
+        stream.write(b'<html><body>' + bytes(1000))
+    assert raised.value.status == 415
+
+
+def test_api_refuses_a_file_that_is_not_an_image(client):
+    response = client.post('/api/denoise', data={'image': (io.BytesIO(b'<html>' + bytes(100_000)), 'photo.png')})
+    assert response.status_code == 415
+
+
+def test_api_refuses_too_many_pixels_from_the_header(app_module, client, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'MAX_IMAGE_PIXELS', 1000)
+    response = client.post('/api/denoise', data={'image': (io.BytesIO(encoded_image()), 'photo.png')})
+    assert response.status_code == 413
+    assert 'megapixels' in response.get_json()['error']
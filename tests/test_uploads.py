@@ -0,0 +1,93 @@
+import io
+from datetime import datetime
+
+import pytest
+
+from conftest import STILL_GIF, encoded_image
+
+
+class FrozenDatetime(datetime):
+    """datetime whose now() is always the same second"""
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2026, 1, 1, 12, 0, 0)
+
+
+def test_same_second_uploads_with_the_same_name(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, 'datetime', FrozenDatetime)
+    monkeypatch.setattr(app_module.time, 'time', lambda: 1767268800.0)
+    # Queue the uploads instead of processing them inline
+    monkeypatch.setitem(app_module.app.config, 'SYNC_COST_THRESHOLD', -1)
+    uploads = [encoded_image(seed=1), encoded_image(seed=2)]
+
+    job_ids = []
+    for data in uploads:
+        response = client.post('/api/denoise', data={'image': (io.BytesIO(data), 'photo.png')})
+        assert response.status_code == 202
+        job_ids.append(response.get_json()['job_id'])
+    monkeypatch.undo()
+
+    assert job_ids[0] != job_ids[1]
+    for job_id, data in zip(job_ids, uploads):
+        job = app_module.job_store.get_job(job_id)
+        assert app_module.job_store.get_blob(job['input_path']) == data
+
+
+def test_client_is_the_address_seen_by_the_proxy(app_module, client, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'SYNC_COST_THRESHOLD', -1)
+    # The leftmost address comes from the client and must not be trusted
+    response = client.post('/api/denoise', data={'image': (io.BytesIO(encoded_image(seed=3)), 'photo.png')},
+                           headers={'X-Forwarded-For': '203.0.113.9, 198.51.100.7'})
+    assert response.status_code == 202
+    job = app_module.job_store.get_job(response.get_json()['job_id'])
+    assert job['client'] == '198.51.100.7'
+
+
+def test_too_large_api_upload_gets_json(client):
+    body = b'\0' * (16 * 1024 * 1024 + 1)
+    response = client.post('/api/denoise', data={'image': (io.BytesIO(body), 'photo.png')})
+    assert response.status_code == 413
+    assert 'too large' in response.get_json()['error']
+
+
+def test_too_large_form_upload_shows_the_form(client):
+    body = b'\0' * (16 * 1024 * 1024 + 1)
+    response = client.post('/', data={'image': (io.BytesIO(body), 'photo.png')})
+    assert response.status_code == 413
+    assert b'File is too large' in response.data
+
+
+def batch_upload(seeds):
+    return {'images': [(io.BytesIO(encoded_image(seed=seed)), f'photo{seed}.png') for seed in seeds]}
+
+
+def test_batch_too_big_for_the_client_limits_is_refused_for_good(app_module, client, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'QUEUE_CAPACITY', 1)
+    # Each 64x48 nlmeans image is estimated at about 4ms
+    monkeypatch.setitem(app_module.app.config, 'CLIENT_MAX_WAIT', 0.01)
+    response = client.post('/api/batch', data=batch_upload([10, 11, 12, 13]))
+    assert response.status_code == 400
+    assert 'Retry-After' not in response.headers
+    assert 'too big' in response.get_json()['error']
+
+
+def test_batch_is_released_to_the_queue_once_admitted(app_module, client):
+    response = client.post('/api/batch', data=batch_upload([20, 21]))
+    assert response.status_code == 202
+    for job_id in response.get_json()['job_ids']:
+        assert app_module.job_store.get_job(job_id)['status'] != 'held'
+
+
+@pytest.mark.parametrize('strength', ['0', '11', '99', '-3'])
+def test_strength_out_of_range_is_refused(client, strength):
+    response = client.post('/api/denoise', data={'image': (io.BytesIO(encoded_image()), 'photo.png'),
+                                                 'strength': strength})
+    assert response.status_code == 400
+    assert 'Strength' in response.get_json()['error']
+
+
+def test_still_gif_is_denoised_as_an_image(client):
+    response = client.post('/api/denoise', data={'image': (io.BytesIO(STILL_GIF), 'photo.gif')})
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
@@ -0,0 +1,63 @@
+"""
+Streaming ingestion of uploads.
+
+werkzeug normally spools every uploaded file to a temporary file (on disk for
+anything over 500KB) before the view sees it, and the view then reads it all
+back to hash and store it. An UploadStream is handed to werkzeug instead: it
+keeps the upload in memory, hashes it while it arrives and checks its first
+bytes as soon as they are in, so a file that isn't a supported image, or is
+far too large, is refused before the rest of the body is read.
+"""
+import io
+import hashlib
+
+
+class UploadRejected(Exception):
+    """Raised while an upload streams in to refuse it, with the HTTP status to answer"""
+
+    def __init__(self, message, status=415):
+        super().__init__(message)
+        self.status = status
+
+
+class UploadStream(io.BytesIO):
+    """
+    In-memory file for an upload that is hashed and checked as it is written
+
+    Parameters:
+    - check: Called as check(header, complete) with the first bytes received
+      until it returns True. It raises UploadRejected to refuse the upload,
+      and returns False while it needs more bytes to decide; complete is set
+      when no more will come.
+    - sniff_bytes: Most bytes passed to check
+    """
+
+    def __init__(self, check=None, sniff_bytes=256 * 1024):
+        super().__init__()
+        self._check = check
+        self._sniff_bytes = sniff_bytes
+        self._hash = hashlib.sha256()
+
+    def write(self, data):
+        self._hash.update(data)
+        written = super().write(data)
+        if self._check is not None:
+            self._run_check(complete=self.tell() >= self._sniff_bytes)
+        return written
+
+    def _run_check(self, complete):
+        with self.getbuffer() as buffer:
+            header = bytes(buffer[:self._sniff_bytes])
+        if self._check(header, complete) or complete:
+            self._check = None
+
+    def finish(self):
+        """
+        Run the checks still waiting for bytes now the whole upload is in
+
+        Returns the uploaded bytes and their SHA-256 hex digest, which is
+        the same as result_cache.content_digest() of them.
+        """
+        if self._check is not None:
+            self._run_check(complete=True)
+        return self.getvalue(), self._hash.hexdigest()
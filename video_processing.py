@@ -0,0 +1,287 @@
+"""
+Video and animated GIF denoising.
+
+Frames are decoded, denoised and re-encoded one at a time, keeping only the
+sliding window of frames the temporal filter needs in memory. nlmeans uses
+OpenCV's multi-frame variant, which also looks at the neighbouring frames and
+so removes noise without the flicker of denoising every frame on its own.
+
+Like image_processing, this module must stay free of Flask/app imports and
+import-time side effects.
+"""
+import os
+import cv2
+import logging
+import tempfile
+from collections import deque
+from functools import partial
+
+from image_processing import (MAX_DIMENSION, estimate_cost, estimate_memory, output_size, prepare_image,
+                              apply_denoise_filter, denoise_tiled, nlmeans_parameters, timed)
+
+logger = logging.getLogger(__name__)
+
+# Containers read through OpenCV's FFmpeg backend. GIFs are treated as videos
+# so animated ones keep all their frames; the app and CLI turn GIFs with a
+# single frame into images first (see image_processing.is_animated_gif)
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.gif')
+
+# Output extension -> FourCC of the codec it is written with. OpenCV can't
+# write GIFs, so those come out as MP4
+VIDEO_CODECS = {
+    '.mp4': 'mp4v',
+    '.mov': 'mp4v',
+    '.mkv': 'mp4v',
+    '.avi': 'MJPG',
+}
+
+# Frames the temporal filter looks at: the frame itself and two on each side
+TEMPORAL_WINDOW = 5
+
+# Used when a file doesn't say its frame rate
+DEFAULT_FPS = 10.0
+
+
+def is_video(filename):
+    """True if the file is one of the VIDEO_EXTENSIONS"""
+    return os.path.splitext(filename)[1].lower() in VIDEO_EXTENSIONS
+
+
+def video_output_ext(ext):
+    """Return the extension a video with the given extension is written as"""
+    ext = ext.lower()
+    return ext if ext in VIDEO_CODECS else '.mp4'
+
+
+def sniff_video_format(data):
+    """
+    Identify a video container from its magic bytes
+    
+    Returns the usual extension of the container ('.mp4', '.mov', '.avi' or
+    '.mkv'; GIFs are recognised by image_processing.sniff_format()), or None.
+    The first twelve bytes are enough.
+    """
+    if data[4:8] == b'ftyp':
+        # MP4 and recent QuickTime files are both ISO base media files
+        return '.mp4'
+    if data[4:8] in (b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot'):
+        # Older QuickTime files start with another atom
+        return '.mov'
+    if data[:4] == b'RIFF' and data[8:12] == b'AVI ':
+        return '.avi'
+    if data[:4] == b'\x1a\x45\xdf\xa3':
+        # EBML header of Matroska and WebM
+        return '.mkv'
+    return None
+
+
+def read_video_info(path):
+    """Return the width, height, frame count and fps of a video, or None if it can't be opened"""
+    capture = cv2.VideoCapture(path)
+    try:
+        if not capture.isOpened():
+            return None
+        return {
+            'width': int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            'height': int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            # Some containers don't store it; count such videos as one frame
+            'frames': max(1, int(capture.get(cv2.CAP_PROP_FRAME_COUNT))),
+            'fps': capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS,
+        }
+    finally:
+        capture.release()
+
+
+def read_video_info_bytes(data, ext):
+    """read_video_info() for a video held in memory"""
+    with tempfile.TemporaryDirectory(prefix='probe_') as directory:
+        path = os.path.join(directory, 'input' + ext)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return read_video_info(path)
+
+
+def estimate_video_cost(info, method="nlmeans", max_dimension=MAX_DIMENSION, grayscale=False,
+                        temporal_window=TEMPORAL_WINDOW):
+    """Estimate how many seconds of CPU time denoising a video will take"""
+    frame_cost = estimate_cost(info['width'], info['height'], method, max_dimension, grayscale)
+    if method == "nlmeans":
+        # Measured: a 5 frame window costs ~3x a single frame, 3 frames ~2x
+        frame_cost *= (temporal_window + 1) / 2
+    return info['frames'] * frame_cost
+
+
+def estimate_video_memory(info, method="nlmeans", max_dimension=MAX_DIMENSION, grayscale=False,
+                          temporal_window=TEMPORAL_WINDOW):
+    """Estimate the peak bytes of memory denoising a video will take"""
+    width, height = output_size(info['width'], info['height'], max_dimension)
+    frame_bytes = width * height * (1 if grayscale else 3)
+    # The window of prepared frames, plus the copy they are stacked into for nlmeans
+    window_bytes = temporal_window * frame_bytes * (2 if method == "nlmeans" else 1)
+    return estimate_memory(info['width'], info['height'], method, max_dimension, grayscale) + window_bytes
+
+
+def read_frames(capture, timings=None):
+    """Yield the frames of an opened cv2.VideoCapture"""
+    while True:
+        with timed(timings, 'decode'):
+            success, frame = capture.read()
+        if not success:
+            return
+        yield frame
+
+
+def temporal_denoise(frames, center, strength=5, method="nlmeans"):
+    """
+    Denoise frames[center] using the frames around it
+
+    frames must be symmetric around center. Methods without a temporal
+    variant filter the center frame on its own.
+    """
+    if method != "nlmeans":
+        return apply_denoise_filter(frames[center], strength, method)
+    color = frames[center].ndim == 3
+    h_luminance, template_window, search_window = nlmeans_parameters(strength, color)
+    if color:
+        return cv2.fastNlMeansDenoisingColoredMulti(
+            frames, center, len(frames), None, h_luminance, h_luminance, template_window, search_window)
+    return cv2.fastNlMeansDenoisingMulti(
+        frames, center, len(frames), None, h_luminance, template_window, search_window)
+
+
+def _denoise_window(stacked, count, strength, method):
+    # denoise_tiled() hands us tiles of the frames stacked along the channel
+    # axis; split them again and return the denoised middle frame
+    channels = stacked.shape[2] // count
+    frames = [stacked[:, :, i * channels:(i + 1) * channels] for i in range(count)]
+    if channels == 1:
+        frames = [frame[:, :, 0].copy() for frame in frames]
+    else:
+        frames = [frame.copy() for frame in frames]
+    return temporal_denoise(frames, count // 2, strength, method)
+
+
+def denoise_frames(frames, strength=5, method="nlmeans", grayscale=False,
+                   max_dimension=MAX_DIMENSION, temporal_window=TEMPORAL_WINDOW,
+                   tile_workers=None, timings=None):
+    """
+    Denoise a stream of frames, yielding each result as soon as it can be made
+
+    Only the last temporal_window frames are kept. Frames near the start and
+    end of the stream use a smaller window that stays centered on them.
+    """
+    half = temporal_window // 2
+    # Frames first_index, first_index + 1, ... that are still needed
+    window = deque()
+    first_index = 0
+    next_index = 0
+    frames = iter(frames)
+    finished = False
+
+    while not finished:
+        frame = next(frames, None)
+        if frame is None:
+            finished = True
+        else:
+            window.append(prepare_image(frame, grayscale, max_dimension, timings))
+
+        last_index = first_index + len(window) - 1
+        # Emit every frame whose following frames are all read
+        while next_index <= last_index and (finished or next_index + half <= last_index):
+            radius = min(half, next_index, last_index - next_index)
+            start = next_index - first_index - radius
+            neighbours = [window[i] for i in range(start, start + 2 * radius + 1)]
+
+            with timed(timings, 'filter'):
+                if len(neighbours) == 1 or method != "nlmeans":
+                    result = denoise_tiled(neighbours[radius],
+                                           partial(apply_denoise_filter, strength=strength, method=method),
+                                           workers=tile_workers)
+                else:
+                    # Tile all frames of the window together so large frames
+                    # are still spread over several cores
+                    stacked = cv2.merge(neighbours)
+                    result = denoise_tiled(stacked,
+                                           partial(_denoise_window, count=len(neighbours),
+                                                   strength=strength, method=method),
+                                           workers=tile_workers,
+                                           channels=1 if neighbours[0].ndim == 2 else neighbours[0].shape[2])
+            yield result
+            next_index += 1
+
+            # Drop frames no later frame needs
+            while first_index < next_index - half:
+                window.popleft()
+                first_index += 1
+
+
+def denoise_video(input_path, output_path, strength=5, method="nlmeans", grayscale=False,
+                  max_dimension=MAX_DIMENSION, temporal_window=TEMPORAL_WINDOW,
+                  tile_workers=None, stats=None, timings=None):
+    """
+    Denoise a video or animated GIF frame by frame
+
+    Parameters are the same as for denoise_image(), plus temporal_window, the
+    number of frames nlmeans looks at for each frame. output_path should have
+    one of the VIDEO_CODECS extensions. stats receives the frame count and the
+    input and output pixel counts.
+    """
+    capture = cv2.VideoCapture(input_path)
+    writer = None
+    try:
+        if not capture.isOpened():
+            raise ValueError(f"Failed to open video {input_path}")
+        fps = capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+        codec = VIDEO_CODECS.get(os.path.splitext(output_path)[1].lower(), VIDEO_CODECS['.mp4'])
+
+        frame_count = 0
+        for frame in denoise_frames(read_frames(capture, timings), strength, method, grayscale,
+                                    max_dimension, temporal_window, tile_workers, timings):
+            with timed(timings, 'encode'):
+                if writer is None:
+                    # The size is only known once the first frame is processed
+                    writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*codec), fps,
+                                             (frame.shape[1], frame.shape[0]), frame.ndim == 3)
+                    if not writer.isOpened():
+                        raise ValueError(f"Failed to write video to {output_path}")
+                writer.write(frame)
+            frame_count += 1
+
+        if frame_count == 0:
+            raise ValueError(f"No frames could be read from {input_path}")
+        if stats is not None:
+            stats['frames'] = frame_count
+            stats['input_pixels'] = frame_count * int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)) * \
+                int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            stats['output_pixels'] = frame_count * frame.shape[0] * frame.shape[1]
+        logger.info(f"Denoised {frame_count} frames of {input_path}")
+        return True, "Processing completed successfully"
+
+    except Exception as e:
+        error_msg = f"Error processing video: {str(e)}"
+        logger.error(error_msg)
+        return False, error_msg
+    finally:
+        capture.release()
+        if writer is not None:
+            writer.release()
+
+
+def denoise_video_bytes(data, input_ext, output_ext, timings=None, **options):
+    """
+    Denoise an encoded video held in memory
+
+    OpenCV only reads and writes videos as files, so the input and output go
+    through a temporary directory; the frames themselves are still streamed.
+    Returns a (success, message, output_bytes) tuple.
+    """
+    with tempfile.TemporaryDirectory(prefix='denoise_') as directory:
+        input_path = os.path.join(directory, 'input' + input_ext)
+        output_path = os.path.join(directory, 'output' + output_ext)
+        with open(input_path, 'wb') as f:
+            f.write(data)
+        success, message = denoise_video(input_path, output_path, timings=timings, **options)
+        if not success:
+            return False, message, None
+        with open(output_path, 'rb') as f:
+            return True, message, f.read()
@@ -0,0 +1,300 @@
+"""
+Process-based worker pool for the denoising jobs.
+
+Denoising is CPU bound and OpenCV runs its own internal thread pool, so the
+jobs are executed in separate worker processes instead of threads. Each worker
+gets its own cv2.setNumThreads() limit so N workers don't oversubscribe the box.
+Jobs can send intermediate results back with report_progress() while they run.
+A memory budget keeps the jobs running at the same time from using more memory
+than the box has.
+"""
+import os
+import time
+import logging
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+from image_processing import denoise_bytes, MAX_DIMENSION
+from video_processing import denoise_video_bytes
+
+logger = logging.getLogger(__name__)
+
+
+def default_pool_size():
+    """Number of worker processes to use when none is configured"""
+    return os.cpu_count() or 1
+
+
+def default_tile_workers(pool_size):
+    """Tile threads per worker that share the CPUs out between pool_size workers"""
+    return max(1, (os.cpu_count() or 1) // pool_size)
+
+
+def default_memory_budget():
+    """
+    Bytes of memory the jobs of one pool may use when no budget is configured
+
+    Half of the physical memory, or None (no limit) where it can't be found.
+    """
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+# Threads each worker uses for the tiles of large images, set by init_worker()
+_tile_workers = None
+# Queue back to the parent process and the id of the task being run
+_progress_queue = None
+_task_id = None
+
+
+def init_worker(cv_threads, tile_workers=None, progress_queue=None):
+    """Initializer executed once in every worker process"""
+    global _tile_workers, _progress_queue
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    # Limit OpenCV's internal threading so the workers don't fight over cores
+    cv2.setNumThreads(cv_threads)
+    _tile_workers = tile_workers
+    _progress_queue = progress_queue
+
+
+def report_progress(payload):
+    """
+    Send an intermediate result of the running task to the parent process
+
+    It is passed to the task's on_progress callback (see WorkerPool.submit()).
+    Does nothing outside a WorkerPool task.
+    """
+    if _progress_queue is not None and _task_id is not None:
+        _progress_queue.put((_task_id, payload))
+
+
+def _run_task(task_id, fn, *args):
+    global _task_id
+    _task_id = task_id
+    try:
+        return fn(*args)
+    finally:
+        _task_id = None
+
+
+def run_denoise_job(data, ext, params, preview=False):
+    """
+    Run a single denoising job inside a worker process
+
+    Takes the encoded input image and returns a
+    (success, message, output_bytes, process_time, timings, thumbnails)
+    tuple, where timings maps each pipeline stage to the seconds spent in it
+    and thumbnails holds the encoded 'input' and 'output' thumbnails. With
+    preview set, a quick low resolution result is sent with report_progress()
+    before the real filter runs.
+    """
+    start_time = time.time()
+    timings = {}
+    thumbnails = {}
+    success, message, output = denoise_bytes(
+        data,
+        ext,
+        strength=params.get('strength', 5),
+        method=params.get('method', 'nlmeans'),
+        grayscale=params.get('grayscale', False),
+        max_dimension=params.get('max_dimension', MAX_DIMENSION),
+        tile_workers=_tile_workers,
+        quality=params.get('output_quality'),
+        sharpen=params.get('sharpen', 0),
+        time_budget=params.get('time_budget'),
+        stages=params.get('pipeline'),
+        timings=timings,
+        preview_callback=report_progress if preview else None,
+        thumbnails=thumbnails
+    )
+    return success, message, output, time.time() - start_time, timings, thumbnails
+
+
+def run_video_job(data, input_ext, output_ext, params):
+    """
+    Run a video denoising job inside a worker process
+
+    Returns the same tuple as run_denoise_job(), without thumbnails. Videos
+    are only denoised; sharpening and custom pipelines are for images.
+    """
+    start_time = time.time()
+    timings = {}
+    success, message, output = denoise_video_bytes(
+        data,
+        input_ext,
+        output_ext,
+        strength=params.get('strength', 5),
+        method=params.get('method', 'nlmeans'),
+        grayscale=params.get('grayscale', False),
+        max_dimension=params.get('max_dimension', MAX_DIMENSION),
+        tile_workers=_tile_workers,
+        timings=timings
+    )
+    return success, message, output, time.time() - start_time, timings, {}
+
+
+class WorkerPool:
+    """
+    Fixed size pool of worker processes
+
+    Parameters:
+    - size: Number of worker processes
+    - cv_threads: Number of threads OpenCV may use inside each worker
+    - tile_workers: Threads each worker uses for the tiles of large images
+      (defaults to the CPUs divided between the workers, so all of them
+      tiling at once don't run more threads than there are CPUs)
+    - memory_budget: Bytes of memory the running jobs may use together, as
+      estimated by their submitters (None for no limit)
+    """
+
+    def __init__(self, size=None, cv_threads=1, tile_workers=None, memory_budget=None):
+        self.size = max(1, int(size or default_pool_size()))
+        self.cv_threads = cv_threads
+        self.tile_workers = tile_workers or default_tile_workers(self.size)
+        self.memory_budget = memory_budget
+        # The workers are started by a fork server rather than forked from this
+        # process, which has threads (the dispatcher's, SQLite's) that may hold
+        # locks at the moment of the fork
+        context = multiprocessing.get_context('forkserver')
+        self._progress_queue = context.Queue()
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.size,
+            mp_context=context,
+            initializer=init_worker,
+            initargs=(cv_threads, self.tile_workers, self._progress_queue)
+        )
+        # One slot per worker process, so jobs wait in our queue rather than
+        # piling up inside the executor where they can't be drained or counted
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+        self._active = 0
+        self._closed = False
+        # Notified whenever a finished job hands back its memory
+        self._memory_freed = threading.Condition(self._lock)
+        self._memory_in_use = 0
+        # Task id -> on_progress callback of the tasks that are running
+        self._task_ids = itertools.count()
+        self._progress_callbacks = {}
+        self._progress_thread = threading.Thread(target=self._dispatch_progress, daemon=True)
+        self._progress_thread.start()
+
+    def _dispatch_progress(self):
+        """Hand the messages of report_progress() to the callbacks of their tasks"""
+        while True:
+            try:
+                message = self._progress_queue.get()
+            except (EOFError, OSError, ValueError):
+                # The queue was closed under us as the interpreter exits
+                return
+            if message is None:
+                return
+            task_id, payload = message
+            with self._lock:
+                callback = self._progress_callbacks.get(task_id)
+            # Messages that arrive after their task finished are dropped
+            if callback is None:
+                continue
+            try:
+                callback(payload)
+            except Exception as e:
+                logger.error(f"Worker progress callback error: {str(e)}")
+
+    @property
+    def active(self):
+        """Number of jobs currently running in the workers"""
+        with self._lock:
+            return self._active
+
+    @property
+    def memory_in_use(self):
+        """Estimated bytes of memory used by the running jobs"""
+        with self._lock:
+            return self._memory_in_use
+
+    def fits(self, memory):
+        """True if a job needing memory bytes could ever run within the budget"""
+        return self.memory_budget is None or memory <= self.memory_budget
+
+    def acquire(self, timeout=None):
+        """
+        Reserve a free worker, waiting up to timeout seconds for one
+
+        Returns True if a worker was reserved. The reservation is used up by
+        the next submit() call, or handed back with release().
+        """
+        if not self._slots.acquire(timeout=timeout):
+            return False
+        with self._lock:
+            if self._closed:
+                self._slots.release()
+                return False
+        return True
+
+    def release(self):
+        """Hand back a reservation that won't be used"""
+        self._slots.release()
+
+    def submit(self, fn, *args, callback=None, on_progress=None, memory=0):
+        """
+        Run fn(*args) in the worker reserved with acquire()
+
+        The callback receives the finished future and is called from a
+        background thread of the executor. on_progress receives whatever fn
+        passes to report_progress() while it runs, on another background
+        thread.
+
+        memory is the estimated peak memory of the job in bytes. If it
+        doesn't fit in what is left of the budget, this waits for running
+        jobs to finish first. A job bigger than the whole budget runs once
+        no other job is running.
+        """
+        task_id = next(self._task_ids)
+        with self._lock:
+            if self.memory_budget is not None:
+                self._memory_freed.wait_for(
+                    lambda: self._memory_in_use == 0 or self._memory_in_use + memory <= self.memory_budget)
+            self._memory_in_use += memory
+            self._active += 1
+            if on_progress is not None:
+                self._progress_callbacks[task_id] = on_progress
+
+        def _done(future):
+            try:
+                if callback is not None:
+                    callback(future)
+            except Exception as e:
+                logger.error(f"Worker callback error: {str(e)}")
+            finally:
+                self._finish(task_id, memory)
+
+        try:
+            future = self._executor.submit(_run_task, task_id, fn, *args)
+        except Exception:
+            self._finish(task_id, memory)
+            raise
+        future.add_done_callback(_done)
+        return future
+
+    def _finish(self, task_id, memory):
+        with self._lock:
+            self._active -= 1
+            self._memory_in_use -= memory
+            self._progress_callbacks.pop(task_id, None)
+            self._memory_freed.notify_all()
+        self._slots.release()
+
+    def shutdown(self, wait=True):
+        """Stop accepting jobs and, if wait is set, let running jobs finish"""
+        with self._lock:
+            self._closed = True
+        self._executor.shutdown(wait=wait)
+        self._progress_queue.put(None)
+        if wait:
+            self._progress_thread.join()